@@ -0,0 +1,322 @@
+"""Benchmark de extremo a extremo del pipeline de subidas y de /ads.
+
+Levanta un Hydrax local (aiohttp) con ancho de banda, latencia y errores configurables,
+un CDN local con soporte de rangos para los enlaces directos y un cliente de Pyrogram
+falso cuyos download_media/stream_media/send_message/edit_message_text simulan tamaños
+de archivo y FloodWait. Después encola N usuarios × M archivos con el planificador real
+de main.py y mide archivos/s, MB/s, latencia p50/p99 por trabajo, RSS máximo y retraso
+del event loop; opcionalmente lanza una difusión /ads y mide mensajes/s.
+
+Uso:
+    python bench/bench_pipeline.py --users 10 --files 5 --size-mb 20
+    python bench/bench_pipeline.py --save-baseline bench/baseline.json
+    python bench/bench_pipeline.py --baseline bench/baseline.json --tolerance 0.2
+
+Con --baseline el proceso termina con código 1 si alguna métrica empeora más que la tolerancia.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+from aiohttp import web
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHUNK = 1024 * 1024
+PATTERN = bytes(range(256)) * (CHUNK // 256)   # contenido sintético barato de generar
+
+# Métricas donde un valor mayor es mejor; el resto, cuanto menor mejor
+HIGHER_IS_BETTER = {"files_per_sec", "mb_per_sec", "ads_msgs_per_sec"}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline de subida a Hydrax y de /ads.")
+    parser.add_argument("--users", type=int, default=8, help="usuarios simultáneos")
+    parser.add_argument("--files", type=int, default=4, help="archivos por usuario")
+    parser.add_argument("--size-mb", type=float, default=16, help="tamaño de cada archivo en MB")
+    parser.add_argument("--source", choices=("telegram", "url", "mixed"), default="mixed")
+    parser.add_argument("--workers", type=int, default=4, help="MAX_WORKERS del planificador")
+    parser.add_argument("--per-user", type=int, default=1, help="MAX_JOBS_PER_USER del planificador")
+    parser.add_argument("--hydrax-mbps", type=float, default=40, help="ancho de banda por subida en Hydrax en MB/s (0 = sin límite)")
+    parser.add_argument("--hydrax-latency", type=float, default=0.05, help="segundos de latencia de respuesta de Hydrax")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probabilidad de error 500 en Hydrax")
+    parser.add_argument("--source-mbps", type=float, default=20, help="ancho de banda por conexión del CDN/Telegram en MB/s (0 = sin límite)")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="probabilidad de FloodWait en cada llamada a Telegram")
+    parser.add_argument("--ads-users", type=int, default=200, help="destinatarios de la difusión /ads (0 = omitir)")
+    parser.add_argument("--ads-rate", type=float, default=200, help="BROADCAST_RATE durante el benchmark")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", help="JSON con resultados previos con los que comparar")
+    parser.add_argument("--save-baseline", help="guarda los resultados como nueva línea base")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="empeoramiento relativo permitido frente a la línea base")
+    return parser.parse_args()
+
+def prepare_environment(args, workdir):
+    # main.py lee su configuración del entorno al importarse y usa rutas relativas
+    os.environ.update(
+        API_ID="1", API_HASH="bench", BOT_TOKEN="1:bench", CREATOR_ID="1", HYDRAX_API_ID="bench",
+        HYDRAX_URL="http://127.0.0.1:{port}".format(port=args.hydrax_port),
+        DB_PATH=os.path.join(workdir, "bench.db"),
+        MAX_WORKERS=str(args.workers), MAX_JOBS_PER_USER=str(args.per_user),
+        PROGRESS_INTERVAL="0.5", BROADCAST_RATE=str(args.ads_rate), SEGMENT_MIN_SIZE=str(8 * CHUNK),
+    )
+    os.symlink(os.path.join(REPO_DIR, "lang"), os.path.join(workdir, "lang"))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+
+async def throttle(nbytes, mbps):
+    if mbps:
+        await asyncio.sleep(nbytes / (mbps * 1024 * 1024))
+
+# --- Servidores locales ---
+
+def hydrax_stub(args, rng):
+    async def upload(request):
+        received = 0
+        async for chunk in request.content.iter_chunked(CHUNK):
+            received += len(chunk)
+            await throttle(len(chunk), args.hydrax_mbps)
+        await asyncio.sleep(args.hydrax_latency)
+        if rng.random() < args.error_rate:
+            return web.Response(status=500, text="error")
+        return web.json_response({"status": True, "slug": f"{request.match_info['api']}-{received}"})
+
+    application = web.Application(client_max_size=0)
+    application.router.add_post("/{api}", upload)
+    return application
+
+def cdn_stub(args):
+    async def serve(request):
+        size = int(request.match_info["size"])
+        start, end = 0, size - 1
+        status = 200
+        range_header = request.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            first, _, last = range_header[6:].partition("-")
+            start, end = int(first), min(int(last) if last else size - 1, size - 1)
+            status = 206
+        response = web.StreamResponse(status=status)
+        response.content_length = end - start + 1
+        response.headers["Accept-Ranges"] = "bytes"
+        response.headers["ETag"] = f'"{request.match_info["name"]}"'
+        if status == 206:
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        await response.prepare(request)
+        position = start
+        while position <= end:
+            n = min(CHUNK - position % CHUNK, end - position + 1)
+            await response.write(PATTERN[position % CHUNK:position % CHUNK + n])
+            await throttle(n, args.source_mbps)
+            position += n
+        await response.write_eof()
+        return response
+
+    application = web.Application()
+    application.router.add_get("/{size}/{name}", serve)
+    return application
+
+async def start_site(application, port):
+    runner = web.AppRunner(application, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+# --- Cliente de Telegram falso ---
+
+class FakeClient:
+    """Sustituye a `app`: simula archivos de Telegram por tamaño y FloodWait aleatorios."""
+
+    def __init__(self, args, rng, flood_wait, blocked_error):
+        self.args = args
+        self.rng = rng
+        self.flood_wait = flood_wait
+        self.blocked_error = blocked_error
+        self.files = {}             # file_id: tamaño
+        self.ids = itertools.count(1000)
+        self.calls = {"send_message": 0, "edit_message_text": 0, "flood_waits": 0}
+
+    def maybe_flood(self):
+        if self.rng.random() < self.args.flood_rate:
+            self.calls["flood_waits"] += 1
+            raise self.flood_wait(value=1)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls["send_message"] += 1
+        if chat_id >= 10_000_000 and chat_id % 17 == 0:
+            raise self.blocked_error()
+        self.maybe_flood()
+        await asyncio.sleep(0.002)
+        return types.SimpleNamespace(id=next(self.ids), chat=types.SimpleNamespace(id=chat_id), text=text)
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self.calls["edit_message_text"] += 1
+        self.maybe_flood()
+        await asyncio.sleep(0.002)
+
+    async def stream_media(self, file_id, limit=0, offset=0):
+        size = self.files[file_id]
+        position = offset * CHUNK
+        while position < size:
+            n = min(CHUNK, size - position)
+            await throttle(n, self.args.source_mbps)
+            yield PATTERN[:n]
+            position += n
+
+    async def download_media(self, file_id, file_name=None, progress=None):
+        size = self.files[file_id]
+        done = 0
+        with open(file_name, "wb") as f:
+            async for chunk in self.stream_media(file_id):
+                f.write(chunk)
+                done += len(chunk)
+                if progress:
+                    await progress(done, size)
+        return file_name
+
+class FakeMessage:
+    def __init__(self, user_id, message_id):
+        self.from_user = types.SimpleNamespace(id=user_id)
+        self.chat = types.SimpleNamespace(id=user_id)
+        self.id = message_id
+
+    async def reply(self, text, **kwargs):
+        return self
+
+# --- Escenarios ---
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+async def run_uploads(main, client, args):
+    size = int(args.size_mb * CHUNK)
+    message_ids = itertools.count(1)
+    for user in range(args.users):
+        user_id = 100 + user
+        for n in range(args.files):
+            use_url = args.source == "url" or (args.source == "mixed" and (user + n) % 2)
+            if use_url:
+                video_info = f"http://127.0.0.1:{args.cdn_port}/{size}/u{user_id}_f{n}.mp4"
+            else:
+                file_id = f"bench_{user_id}_{n}"
+                client.files[file_id] = size
+                video_info = {"file_id": file_id, "file_unique_id": file_id, "file_name": f"{file_id}.mp4",
+                              "mime_type": "video/mp4", "file_size": size}
+            await main.enqueue_video(FakeMessage(user_id, next(message_ids)), video_info)
+    started = time.monotonic()
+    while main.scheduler.pending_count() or main.scheduler.running_count():
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - started
+    rows = main.db_query("SELECT state, created_at, updated_at FROM jobs")
+    done = [row for row in rows if row["state"] == "done"]
+    latencies = [row["updated_at"] - row["created_at"] for row in done]
+    return {
+        "jobs": len(rows),
+        "jobs_failed": len(rows) - len(done),
+        "elapsed_sec": round(elapsed, 3),
+        "files_per_sec": round(len(done) / elapsed, 3) if elapsed else 0.0,
+        "mb_per_sec": round(len(done) * args.size_mb / elapsed, 3) if elapsed else 0.0,
+        "job_latency_p50": round(percentile(latencies, 0.5), 3),
+        "job_latency_p99": round(percentile(latencies, 0.99), 3),
+    }
+
+async def run_ads(main, args):
+    recipients = [10_000_000 + i for i in range(args.ads_users)]
+    started = time.monotonic()
+    campaign_id = await main.create_campaign(1, ["bench ad 1", "bench ad 2"], recipients)
+    await main.run_campaign(campaign_id)
+    elapsed = time.monotonic() - started
+    rows = main.db_query("SELECT status FROM campaign_recipients WHERE campaign_id = ?", (campaign_id,))
+    counts = main.campaign_counts(rows)
+    return {
+        "ads_elapsed_sec": round(elapsed, 3),
+        "ads_msgs_per_sec": round(counts["sent"] * 2 / elapsed, 3) if elapsed else 0.0,
+        "ads_sent": counts["sent"],
+        "ads_blocked": counts["blocked"],
+        "ads_failed": counts["failed"],
+    }
+
+async def run_benchmark(args):
+    import main
+    from pyrogram.errors import FloodWait, UserIsBlocked
+
+    rng = random.Random(args.seed)
+    client = FakeClient(args, rng, FloodWait, UserIsBlocked)
+    main.app = client
+    runners = [await start_site(hydrax_stub(args, rng), args.hydrax_port), await start_site(cdn_stub(args), args.cdn_port)]
+    monitor = asyncio.create_task(main.monitor_event_loop())
+    main.scheduler.start()
+    try:
+        results = await run_uploads(main, client, args)
+        if args.ads_users:
+            results.update(await run_ads(main, args))
+    finally:
+        await main.scheduler.stop()
+        monitor.cancel()
+        await main.close_hydrax_session()
+        await main.close_http_session()
+        for runner in runners:
+            await runner.cleanup()
+    lag_p99 = main.LOOP_LAG_SECONDS.quantile(0.99)
+    results.update(
+        peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        loop_lag_p99_ms=round((lag_p99 or 0) * 1000, 1),
+        telegram_calls=client.calls,
+    )
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, old in baseline.get("results", {}).items():
+        new = results.get(name)
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or not old:
+            continue
+        change = (new - old) / old
+        worse = change < -tolerance if name in HIGHER_IS_BETTER else change > tolerance
+        marker = "REGRESIÓN" if worse else "ok"
+        print(f"  {name:20} {old:>12} → {new:>12} ({change:+.1%}) {marker}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+def main_cli():
+    args = parse_args()
+    args.hydrax_port, args.cdn_port = 18765, 18766
+    workdir = tempfile.mkdtemp(prefix="hydra_bench_")
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    save_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    try:
+        prepare_environment(args, workdir)
+        results = asyncio.run(run_benchmark(args))
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    config = {k: v for k, v in vars(args).items() if k not in ("baseline", "save_baseline", "tolerance", "hydrax_port", "cdn_port")}
+    print(json.dumps({"config": config, "results": results}, indent=2, ensure_ascii=False))
+    if save_path:
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "results": results}, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"Línea base guardada en {save_path}")
+    if baseline_path:
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print("Aviso: la configuración difiere de la línea base; la comparación puede no ser válida.")
+        print("Comparación con la línea base:")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Regresiones: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,12 +1,33 @@
 import os
+import sys
 import json
 import logging
+import logging.handlers
 import time
-import requests
+import gzip
+import shutil
+import errno
+import re
+import queue
+import atexit
+import io
+import uuid
+import hashlib
+import html
+import sqlite3
+import urllib.parse
+import threading
 import asyncio
 import aiohttp
+from aiohttp import web
+from collections import deque
 from datetime import datetime, timezone
-from pyrogram import Client, filters
+from pyrogram import Client, enums, filters, idle, raw, types
+from pyrogram.errors import (
+    FloodWait, MessageNotModified, UserIsBlocked, InputUserDeactivated, PeerIdInvalid,
+    UserDeactivated, UserDeactivatedBan, ChatWriteForbidden, UserIsBot, RPCError,
+)
+from pyrogram.session import Session
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 # --- CONFIGURACIÓN Y PERSISTENCIA ---
@@ -17,22 +38,99 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 CREATOR_ID = int(os.getenv("CREATOR_ID"))
 HYDRAX_API_ID = os.getenv("HYDRAX_API_ID")
 
-logging.basicConfig(
-    filename="bot.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
+# Modo de despliegue: "all" (un solo proceso), "frontend" (solo Telegram y cola) o "worker" (solo transferencias)
+BOT_MODE = os.getenv("BOT_MODE", "all")
+WORKER_ID = os.getenv("WORKER_ID", "1")
+if BOT_MODE not in ("all", "frontend", "worker"):
+    raise SystemExit(f"BOT_MODE no válido: {BOT_MODE} (usa all, frontend o worker)")
+
+# --- Log estructurado (JSON por línea) con escritura en segundo plano y rotación ---
+# Cada worker escribe su propio fichero: la rotación no es segura entre procesos
+LOG_FILE = os.getenv("LOG_FILE", f"bot-worker-{WORKER_ID}.log" if BOT_MODE == "worker" else "bot.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))   # rota al superar este tamaño
+LOG_ROTATE_INTERVAL = int(os.getenv("LOG_ROTATE_INTERVAL", str(24 * 3600)))  # o al pasar este tiempo (segundos)
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "10"))                         # ficheros rotados (.gz) que se conservan
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por evento: ts, level, msg y los campos estructurados pasados a log_event.
+
+    El QueueHandler ya deja la traza de las excepciones dentro de `msg`.
+    """
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "msg": record.getMessage(),
+        }
+        if record.name != "root":
+            entry["logger"] = record.name   # p. ej. mensajes internos de pyrogram
+        entry.update(getattr(record, "fields", None) or {})
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SizeTimeRotatingHandler(logging.handlers.RotatingFileHandler):
+    """Rota por tamaño o por antigüedad del fichero, lo que ocurra antes, y comprime los rotados con gzip."""
+
+    def __init__(self, filename, max_bytes, interval, backups):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        self.interval = interval
+        self.opened_at = self.started_at()
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self.compress
+
+    def started_at(self):
+        """Momento en que empezó el fichero actual, para que reiniciar el bot no reinicie la cuenta de la rotación.
+
+        Se usa la fecha de creación si el sistema la da y, si no, el `ts` de la primera línea
+        (la mtime no sirve: cambia con cada escritura).
+        """
+        try:
+            stat = os.stat(self.baseFilename)
+        except OSError:
+            return time.time()
+        if getattr(stat, "st_birthtime", None):
+            return stat.st_birthtime
+        try:
+            with open(self.baseFilename, encoding="utf-8") as f:
+                return datetime.fromisoformat(json.loads(f.readline())["ts"]).timestamp()
+        except (OSError, ValueError, KeyError, TypeError):
+            return stat.st_mtime
+
+    @staticmethod
+    def compress(source, dest):
+        with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+    def shouldRollover(self, record):
+        if self.interval and time.time() - self.opened_at >= self.interval and os.path.getsize(self.baseFilename):
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.opened_at = time.time()
+
+# El bucle de eventos solo encola el registro; la escritura, rotación y compresión van en un hilo aparte
+log_handler = SizeTimeRotatingHandler(LOG_FILE, LOG_MAX_BYTES, LOG_ROTATE_INTERVAL, LOG_BACKUPS)
+log_handler.setFormatter(JsonFormatter())
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, log_handler, respect_handler_level=True)
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+log_listener.start()
+atexit.register(log_listener.stop)
 
-def log_event(event):
-    logging.info(f"{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')} — {event}")
+def log_event(event, level="info", **fields):
+    logging.log(logging.getLevelName(level.upper()), event, extra={"fields": fields})
 
 def load_lang(lang_code):
     try:
         with open(f'lang/{lang_code}.json', 'r', encoding="utf-8") as f:
             return json.load(f)
     except Exception as e:
-        log_event(f"Error cargando idioma {lang_code}: {e}")
+        log_event(f"Error cargando idioma {lang_code}: {e}", level="error")
         return {}
 
 def load_json(filename, default):
@@ -41,9 +139,241 @@ def load_json(filename, default):
             return json.load(f)
     return default
 
-def save_json(filename, data):
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(data, f)
+# --- Base de datos SQLite (modo WAL) para el estado que debe sobrevivir a reinicios ---
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", str(7 * 24 * 3600)))  # segundos que se guardan los trabajos terminados
+
+db = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+db.row_factory = sqlite3.Row
+db.execute("PRAGMA journal_mode=WAL")
+db.execute("PRAGMA synchronous=NORMAL")
+db.execute("PRAGMA busy_timeout=5000")
+db_lock = threading.Lock()
+
+db.executescript("""
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    reply_to INTEGER,
+    source_kind TEXT NOT NULL,
+    source TEXT NOT NULL,
+    video_info TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    stage TEXT,
+    bytes_done INTEGER NOT NULL DEFAULT 0,
+    bytes_total INTEGER NOT NULL DEFAULT 0,
+    status_msg_id INTEGER,
+    local_path TEXT,
+    result TEXT,
+    worker TEXT,
+    claimed_at REAL,
+    notified INTEGER NOT NULL DEFAULT 1,
+    batch_id INTEGER,
+    destination TEXT NOT NULL DEFAULT 'hydrax',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE TABLE IF NOT EXISTS batches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    status_msg_id INTEGER,
+    total INTEGER NOT NULL,
+    rejected TEXT NOT NULL DEFAULT '[]',
+    state TEXT NOT NULL DEFAULT 'running',
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS workers (
+    id TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    slots INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'running',
+    heartbeat REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS campaigns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    messages TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'running',
+    owner_id INTEGER NOT NULL,
+    progress_msg_id INTEGER,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS campaign_recipients (
+    campaign_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    parts_sent INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (campaign_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS upload_cache (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (scope, key)
+);
+CREATE INDEX IF NOT EXISTS upload_cache_last_used ON upload_cache (last_used);
+CREATE TABLE IF NOT EXISTS settings (
+    ns TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (ns, key)
+);
+""")
+
+def ensure_columns(table, columns):
+    # Migración de bases de datos creadas por versiones anteriores
+    existing = {row["name"] for row in db.execute(f"PRAGMA table_info({table})")}
+    for name, decl in columns.items():
+        if name not in existing:
+            try:
+                db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+            except sqlite3.OperationalError as e:
+                if "duplicate column" not in str(e):   # otro proceso la añadió a la vez
+                    raise
+
+ensure_columns("workers", {"stats": "TEXT"})
+ensure_columns("jobs", {"worker": "TEXT", "claimed_at": "REAL", "notified": "INTEGER NOT NULL DEFAULT 1", "batch_id": "INTEGER",
+                       "destination": "TEXT NOT NULL DEFAULT 'hydrax'"})
+db.execute("CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, state)")
+db.execute("CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch_id)")
+
+def db_query(sql, params=()):
+    with db_lock:
+        return db.execute(sql, params).fetchall()
+
+async def db_run(sql, params=()):
+    # Las consultas van a un hilo para no bloquear el event loop
+    return await asyncio.to_thread(db_query, sql, params)
+
+# --- Configuración persistente por clave (sustituye a los JSON completos) ---
+SETTINGS_FLUSH_INTERVAL = float(os.getenv("SETTINGS_FLUSH_INTERVAL", "2"))
+
+settings_dirty = {}     # (ns, key): valor JSON, o None si se borró; pendiente de volcar
+
+def write_settings(batch):
+    """Escribe un lote de cambios en una sola transacción atómica (se ejecuta en un hilo)."""
+    with db_lock:
+        try:
+            db.execute("BEGIN")
+            for (ns, key), value in batch.items():
+                if value is None:
+                    db.execute("DELETE FROM settings WHERE ns = ? AND key = ?", (ns, key))
+                else:
+                    db.execute("INSERT OR REPLACE INTO settings (ns, key, value) VALUES (?, ?, ?)", (ns, key, value))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+async def flush_settings():
+    """Vuelca todos los cambios pendientes. La instantánea se toma en el event loop, donde escriben los
+    manejadores, para que ningún cambio hecho durante la escritura se pierda."""
+    global settings_dirty
+    if not settings_dirty:
+        return
+    batch, settings_dirty = settings_dirty, {}
+    try:
+        await asyncio.to_thread(write_settings, batch)
+    except Exception:
+        # Los cambios vuelven a quedar pendientes salvo que haya otros más nuevos
+        for item, value in batch.items():
+            settings_dirty.setdefault(item, value)
+        raise
+
+async def settings_flusher():
+    while True:
+        await asyncio.sleep(SETTINGS_FLUSH_INTERVAL)
+        try:
+            await flush_settings()
+        except Exception as e:
+            log_event(f"Error guardando configuración: {e}", level="error")
+
+def load_settings(ns, legacy_file):
+    """Lee un espacio de nombres; la primera vez importa el JSON antiguo si existe."""
+    marker = f"imported:{ns}"
+    imported = db_query("SELECT 1 FROM settings WHERE ns = 'meta' AND key = ?", (marker,))
+    if not imported:
+        legacy = load_json(legacy_file, None)
+        with db_lock:
+            db.execute("BEGIN")
+            if legacy is not None:
+                items = legacy.items() if isinstance(legacy, dict) else ((str(k), True) for k in legacy)
+                db.executemany("INSERT OR REPLACE INTO settings (ns, key, value) VALUES (?, ?, ?)",
+                               [(ns, str(k), json.dumps(v)) for k, v in items])
+            db.execute("INSERT INTO settings (ns, key, value) VALUES ('meta', ?, 'true')", (marker,))
+            db.execute("COMMIT")
+        if legacy is not None:
+            log_event(f"Importado {legacy_file} a la base de datos ({len(legacy)} entradas).")
+    rows = db_query("SELECT key, value FROM settings WHERE ns = ?", (ns,))
+    return {row["key"]: json.loads(row["value"]) for row in rows}, not imported
+
+class PersistentDict(dict):
+    """dict en memoria cuyas escrituras se guardan por clave (O(1)) en el siguiente volcado por lotes."""
+
+    def __init__(self, ns, legacy_file):
+        data, _ = load_settings(ns, legacy_file)
+        super().__init__(data)
+        self.ns = ns
+
+    def __setitem__(self, key, value):
+        if key in self and self[key] == value:
+            return
+        super().__setitem__(key, value)
+        settings_dirty[(self.ns, str(key))] = json.dumps(value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        settings_dirty[(self.ns, str(key))] = None
+
+    def pop(self, key, *default):
+        if key in self:
+            settings_dirty[(self.ns, str(key))] = None
+        return super().pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def fetch(self):
+        """Lee de la base de datos el espacio de nombres (en modo worker lo cambia el frontend); para un hilo aparte."""
+        rows = db_query("SELECT key, value FROM settings WHERE ns = ?", (self.ns,))
+        return {row["key"]: json.loads(row["value"]) for row in rows}
+
+    def replace(self, data):
+        # Se llama en el event loop con lo que devolvió fetch(): sin await de por medio,
+        # ningún trabajo llega a ver el diccionario a medio rellenar
+        super().clear()
+        super().update(data)
+
+class PersistentSet(set):
+    """Conjunto de user_id con la misma persistencia por clave que PersistentDict."""
+
+    def __init__(self, ns, legacy_file, default=()):
+        data, first_run = load_settings(ns, legacy_file)
+        super().__init__(int(key) for key in data)
+        self.ns = ns
+        if first_run and not data:
+            for item in default:
+                self.add(item)
+
+    def add(self, item):
+        if item not in self:
+            super().add(item)
+            settings_dirty[(self.ns, str(item))] = "true"
+
+    def discard(self, item):
+        if item in self:
+            super().discard(item)
+            settings_dirty[(self.ns, str(item))] = None
 
 # --- Idiomas ---
 LANGS = {
@@ -51,25 +381,25 @@ LANGS = {
     "en": load_lang("en"),
 }
 DEFAULT_LANG = "en"
-user_langs = load_json("user_langs.json", {})
+user_langs = PersistentDict("user_langs", "user_langs.json")
 
 # --- Usuarios y configuración persistente ---
-allowed_users = set(load_json("allowed_users.json", [CREATOR_ID]))
-user_server = load_json("user_server.json", {})
-user_hydrax_api = load_json("user_hydrax_api.json", {})
+allowed_users = PersistentSet("allowed_users", "allowed_users.json", default=[CREATOR_ID])
+user_server = PersistentDict("user_server", "user_server.json")
+user_hydrax_api = PersistentDict("user_hydrax_api", "user_hydrax_api.json")
 
 user_pending_hapi = {}  # user_id: api_key (temporal hasta confirmación)
 user_ads_state = {}     # user_id: dict con estado del anuncio
 
-# --- Cola y estado de subida por usuario ---
-user_video_queue = {}   # user_id: [ (message, video_info/url) ]
-user_uploading = {}     # user_id: bool
-
 # --- Carpeta temporal para descargas ---
 TEMP_DIR = "temp"
 os.makedirs(TEMP_DIR, exist_ok=True)
 
-app = Client("auu_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+if BOT_MODE == "worker":
+    # Un worker solo usa Telegram para descargar: sesión propia y sin recibir updates
+    app = Client(f"auu_bot_worker_{WORKER_ID}", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, no_updates=True)
+else:
+    app = Client("auu_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
 def get_user_lang(user_id):
     return user_langs.get(str(user_id), DEFAULT_LANG)
@@ -78,89 +408,2364 @@ def t(user_id, key):
     lang = get_user_lang(user_id)
     return LANGS.get(lang, LANGS[DEFAULT_LANG]).get(key, key)
 
-def is_direct_video_url(text):
-    if isinstance(text, str):
-        return text.lower().endswith(('.mp4', '.mkv', '.mov', '.avi', '.webm', '.flv')) and (text.startswith("http://") or text.startswith("https://"))
-    return False
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.mov', '.avi', '.webm', '.flv')
 
 def make_progress_bar(percent, length=20):
     filled = int(percent / 100 * length)
     bar = '█' * filled + '-' * (length - filled)
     return f"[{bar}] {percent:.1f}%"
 
-async def upload_to_hydrax(api_id, file_path, file_name, file_type, progress_callback):
-    url = f"http://up.hydrax.net/{api_id}"
-    file_size = os.path.getsize(file_path)
+# --- MÉTRICAS ---
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))          # 0 = sin endpoint HTTP de Prometheus
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+LOOP_LAG_INTERVAL = 0.5     # segundos entre mediciones del retraso del event loop
+THROUGHPUT_WINDOW = 5       # segundos de la ventana para bytes/s actuales
+
+def escape_label(value):
+    # Formato de texto de Prometheus: \, " y saltos de línea van escapados dentro del valor
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def snapshot(self):
+        return [[list(key), value] for key, value in self.values.items()]
+
+    def merged(self, snapshots):
+        """Copia de este contador con los valores de otros procesos (`snapshot()` de cada uno) sumados."""
+        merged = Counter(self.name, self.help)
+        merged.values = dict(self.values)
+        for snapshot in snapshots:
+            for key, value in snapshot:
+                key = tuple(tuple(pair) for pair in key)
+                merged.values[key] = merged.values.get(key, 0) + value
+        return merged
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{format_labels(key)} {value}" for key, value in self.values.items()]
+        return lines
+
+class Gauge:
+    """Gauge calculado al leerlo: `collect()` devuelve [(labels, valor)]."""
+
+    def __init__(self, name, help_text, collect):
+        self.name = name
+        self.help = help_text
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        lines += [f"{self.name}{format_labels(tuple(sorted(labels.items())))} {value}" for labels, value in self.collect()]
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = sorted(buckets)
+        self.series = {}    # labels: [conteos por bucket..., +Inf], suma
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        counts, total = self.series.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self.series[key] = (counts, total + value)
+
+    def count(self, **labels):
+        series = self.series.get(tuple(sorted(labels.items())))
+        return sum(series[0]) if series else 0
+
+    def quantile(self, q, **labels):
+        # Aproximación por interpolación lineal dentro del bucket, como histogram_quantile()
+        series = self.series.get(tuple(sorted(labels.items())))
+        if not series or not sum(series[0]):
+            return None
+        counts = series[0]
+        rank = q * sum(counts)
+        seen = 0
+        lower = 0.0
+        for i, bound in enumerate(self.buckets):
+            if seen + counts[i] >= rank:
+                return lower + (bound - lower) * ((rank - seen) / counts[i] if counts[i] else 0)
+            seen += counts[i]
+            lower = bound
+        return self.buckets[-1]
+
+    def snapshot(self):
+        return [[list(key), counts, total] for key, (counts, total) in self.series.items()]
+
+    def merged(self, snapshots):
+        """Copia de este histograma con las series de otros procesos sumadas bucket a bucket."""
+        merged = Histogram(self.name, self.help, self.buckets)
+        merged.series = {key: (list(counts), total) for key, (counts, total) in self.series.items()}
+        for snapshot in snapshots:
+            for key, counts, total in snapshot:
+                key = tuple(tuple(pair) for pair in key)
+                current, current_total = merged.series.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+                merged.series[key] = ([a + b for a, b in zip(current, counts)], current_total + total)
+        return merged
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+BYTES_TRANSFERRED = Counter("hydra_bytes_total", "Bytes transferidos por dirección (download/upload).")
+JOBS_FINISHED = Counter("hydra_jobs_total", "Trabajos terminados por resultado (done/cached/failed).")
+HYDRAX_ERRORS = Counter("hydra_hydrax_errors_total", "Errores en subidas a Hydrax por tipo.")
+HYDRAX_KEY_UPLOADS = Counter("hydra_hydrax_key_uploads_total", "Intentos de subida a Hydrax por clave y resultado (ok/error).")
+HYDRAX_KEY_BYTES = Counter("hydra_hydrax_key_bytes_total", "Bytes subidos con éxito por clave de Hydrax.")
+FLOOD_WAITS = Counter("hydra_floodwait_total", "FloodWait recibidos de Telegram por origen.")
+JOB_STAGE_SECONDS = Histogram(
+    "hydra_job_stage_seconds", "Duración de cada etapa de un trabajo.",
+    [1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200],
+)
+LOOP_LAG_SECONDS = Histogram(
+    "hydra_event_loop_lag_seconds", "Retraso del event loop respecto a lo programado.",
+    [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5],
+)
+loop_lag_last = 0.0
+throughput = {"download": 0.0, "upload": 0.0}   # bytes/s en la última ventana
+# Métricas que en BOT_MODE=frontend viven en los workers: cada uno las publica en bot.db con su latido
+# y el frontend las suma a las suyas. Los trabajos terminados no están: el frontend los cuenta al notificarlos.
+WORKER_METRICS = (BYTES_TRANSFERRED, HYDRAX_ERRORS, HYDRAX_KEY_UPLOADS, HYDRAX_KEY_BYTES, FLOOD_WAITS, JOB_STAGE_SECONDS)
+
+async def monitor_event_loop():
+    """Mide el retraso del event loop y la velocidad actual de descarga/subida."""
+    global loop_lag_last
+    window_start = time.monotonic()
+    window_bytes = {d: BYTES_TRANSFERRED.get(direction=d) for d in throughput}
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        now = time.monotonic()
+        loop_lag_last = max(now - start - LOOP_LAG_INTERVAL, 0.0)
+        LOOP_LAG_SECONDS.observe(loop_lag_last)
+        if now - window_start >= THROUGHPUT_WINDOW:
+            for direction in throughput:
+                current = BYTES_TRANSFERRED.get(direction=direction)
+                throughput[direction] = (current - window_bytes[direction]) / (now - window_start)
+                window_bytes[direction] = current
+            window_start = now
+
+def metrics_snapshot():
+    """Lo que un worker publica en la tabla workers con cada latido."""
+    return {
+        "worker": WORKER_ID,
+        "metrics": {metric.name: metric.snapshot() for metric in WORKER_METRICS},
+        "throughput": throughput,
+        "temp": {"budget": temp_storage.budget, "reserved": temp_storage.reserved(), "waiting": len(temp_storage.waiters)},
+        "keys": hydrax_dispatcher.stats(),
+    }
+
+async def worker_stats():
+    """Métricas publicadas por los workers vivos (vacío salvo en BOT_MODE=frontend)."""
+    if BOT_MODE != "frontend":
+        return []
+    rows = await db_run("SELECT stats FROM workers WHERE heartbeat > ? AND stats IS NOT NULL", (time.time() - WORKER_TIMEOUT,))
+    return [json.loads(row["stats"]) for row in rows]
+
+def cluster_metric(metric, workers):
+    return metric.merged([w["metrics"].get(metric.name, []) for w in workers]) if workers and metric in WORKER_METRICS else metric
+
+def cluster_throughput(workers):
+    return {d: v + sum(w["throughput"].get(d, 0.0) for w in workers) for d, v in throughput.items()}
+
+def cluster_temp(workers):
+    # En modo frontend el disco lo usan los workers; todos comparten TEMP_DIR y un mismo presupuesto
+    if BOT_MODE != "frontend":
+        return {"budget": temp_storage.budget, "reserved": temp_storage.reserved(), "waiting": len(temp_storage.waiters)}
+    return {"budget": max((w["temp"]["budget"] for w in workers), default=0),
+            "reserved": sum(w["temp"]["reserved"] for w in workers),
+            "waiting": sum(w["temp"]["waiting"] for w in workers)}
+
+def cluster_key_stats(workers):
+    # Cada proceso lleva su propio circuito por clave: se muestra el peor estado y se suman los contadores
+    order = ("closed", "half_open", "open")
+    keys = {}
+    for stats in [hydrax_dispatcher.stats()] + [w["keys"] for w in workers]:
+        for s in stats:
+            key = keys.setdefault(s["key"], {"key": s["key"], "state": "closed", "active": 0, "uploads": 0,
+                                             "errors": 0, "bytes": 0, "speed": 0.0})
+            key["state"] = max(key["state"], s["state"], key=order.index)
+            for field in ("active", "uploads", "errors", "bytes", "speed"):
+                key[field] += s[field]
+    return list(keys.values())
+
+def render_metrics(workers=()):
+    rates = cluster_throughput(workers)
+    temp = cluster_temp(workers)
+    keys = cluster_key_stats(workers)
+    gauges = [
+        Gauge("hydra_queue_depth", "Trabajos en espera por usuario.",
+              lambda: [({"user": uid}, len(q)) for uid, q in scheduler.queues.items()]),
+        Gauge("hydra_queue_depth_total", "Trabajos en espera en total.", lambda: [({}, scheduler.pending_count())]),
+        Gauge("hydra_jobs_running", "Trabajos en curso.", lambda: [({}, scheduler.running_count())]),
+        Gauge("hydra_throughput_bytes_per_second", "Velocidad actual por dirección.",
+              lambda: [({"direction": d}, v) for d, v in rates.items()]),
+        Gauge("hydra_event_loop_lag_last_seconds", "Último retraso medido del event loop.", lambda: [({}, loop_lag_last)]),
+        Gauge("hydra_temp_bytes", "Presupuesto y bytes reservados de TEMP_DIR.",
+              lambda: [({"kind": "budget"}, temp["budget"]), ({"kind": "reserved"}, temp["reserved"])]),
+        Gauge("hydra_temp_waiting_jobs", "Trabajos esperando espacio en disco.", lambda: [({}, temp["waiting"])]),
+        Gauge("hydra_hydrax_key_circuit_open", "1 si el circuito de la clave de Hydrax está abierto.",
+              lambda: [({"key": s["key"]}, int(s["state"] == "open")) for s in keys]),
+        Gauge("hydra_hydrax_key_active", "Subidas en curso por clave de Hydrax.",
+              lambda: [({"key": s["key"]}, s["active"]) for s in keys]),
+    ]
+    lines = []
+    for metric in (BYTES_TRANSFERRED, JOBS_FINISHED, HYDRAX_ERRORS, HYDRAX_KEY_UPLOADS, HYDRAX_KEY_BYTES, FLOOD_WAITS, JOB_STAGE_SECONDS, LOOP_LAG_SECONDS, *gauges):
+        lines += cluster_metric(metric, workers).render()
+    return "\n".join(lines) + "\n"
+
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+
+    async def metrics_handler(request):
+        return web.Response(text=render_metrics(await worker_stats()), content_type="text/plain", charset="utf-8")
+
+    metrics_app = web.Application()
+    metrics_app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(metrics_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    log_event(f"Métricas disponibles en http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+# --- REPORTE DE PROGRESO ---
+
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "3"))   # segundos mínimos entre ediciones
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m {seconds % 60:02d}s"
+
+class ProgressReporter:
+    """Dueño de un mensaje de estado: guarda solo el último estado y lo edita como mucho cada `interval` segundos.
+
+    `update()` es síncrono y nunca espera a Telegram, así que las transferencias no se frenan por las ediciones.
+    """
+
+    def __init__(self, user_id, chat_id, message_id, interval=PROGRESS_INTERVAL, job_id=None, timed=True):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.job_id = job_id        # si se indica, el progreso se guarda también en la cola persistente
+        self.interval = interval
+        self.timed = timed          # False en el frontend: las etapas las mide el worker que hace el trabajo
+        self.stage = None
+        self.current = 0
+        self.total = 0
+        self.speed = 0.0            # bytes/s (media móvil exponencial)
+        self.sample = None          # (monotonic, bytes) de la última medición
+        self.last_key = None        # (etapa, barra) del último texto enviado
+        self.stage_started = None
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def end_stage(self):
+        if self.timed and self.stage is not None and self.stage_started is not None:
+            JOB_STAGE_SECONDS.observe(time.monotonic() - self.stage_started, stage=self.stage.removeprefix("video_"))
+            self.stage_started = None
+
+    def update(self, stage, current, total):
+        if stage != self.stage:
+            self.end_stage()
+            self.stage = stage
+            self.stage_started = time.monotonic()
+            self.speed = 0.0
+            self.sample = None
+        self.current = current
+        self.total = total
+
+    def measure(self):
+        now = time.monotonic()
+        if self.sample is not None:
+            elapsed = now - self.sample[0]
+            if elapsed > 0:
+                rate = max(self.current - self.sample[1], 0) / elapsed
+                self.speed = rate if not self.speed else 0.7 * self.speed + 0.3 * rate
+        self.sample = (now, self.current)
+
+    def render(self):
+        percent = min(self.current * 100 / self.total, 100) if self.total else 0
+        bar = make_progress_bar(percent)
+        text = f"{t(self.user_id, self.stage)}\n{bar}"
+        if self.speed > 0:
+            text += f"\n⚡ {format_bytes(self.speed)}/s"
+            if self.total > self.current:
+                text += f" · ⏳ {format_eta((self.total - self.current) / self.speed)}"
+        return (self.stage, bar), text
+
+    async def flush(self):
+        if self.stage is None:
+            return
+        self.measure()
+        if self.job_id is not None:
+            try:
+                await update_job(self.job_id, stage=self.stage, bytes_done=self.current, bytes_total=self.total)
+            except Exception as e:
+                log_event(f"Error guardando progreso del trabajo {self.job_id}: {e}", level="error", job_id=self.job_id)
+        if self.message_id is None:
+            return  # worker separado: el frontend dibuja el progreso a partir de la base de datos
+        key, text = self.render()
+        if key == self.last_key:
+            return
+        try:
+            await app.edit_message_text(self.chat_id, self.message_id, text)
+            self.last_key = key
+        except FloodWait as e:
+            # Solo se retrasa el reporte; la transferencia sigue su curso
+            FLOOD_WAITS.inc(source="progress")
+            await asyncio.sleep(e.value)
+        except MessageNotModified:
+            self.last_key = key
+        except Exception as e:
+            log_event(f"Error actualizando progreso de {self.user_id}: {e}", level="error", user_id=self.user_id)
+
+    def callback(self, stage):
+        # Callback (actual, total) para los motores de transferencia
+        return lambda current, total: self.update(stage, current, total)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def close(self):
+        self.end_stage()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def finish(self, text):
+        """Detiene los reportes periódicos y deja el texto final (este sí se espera)."""
+        await self.close()
+        if self.message_id is None:
+            return
+        for _ in range(3):
+            try:
+                await app.edit_message_text(self.chat_id, self.message_id, text)
+                return
+            except FloodWait as e:
+                FLOOD_WAITS.inc(source="progress")
+                await asyncio.sleep(e.value)
+            except MessageNotModified:
+                return
+            except Exception as e:
+                log_event(f"Error en mensaje final de {self.user_id}: {e}", level="error", user_id=self.user_id)
+                return
+
+# --- MOTOR DE SUBIDA ASÍNCRONO A HYDRAX ---
+
+HYDRAX_URL = os.getenv("HYDRAX_URL", "http://up.hydrax.net")
+HYDRAX_POOL_SIZE = int(os.getenv("HYDRAX_POOL_SIZE", "32"))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+hydrax_session = None   # aiohttp.ClientSession compartida entre todas las subidas
+
+def get_hydrax_session():
+    global hydrax_session
+    if hydrax_session is None or hydrax_session.closed:
+        hydrax_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HYDRAX_POOL_SIZE, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=600),
+        )
+    return hydrax_session
+
+async def close_hydrax_session():
+    global hydrax_session
+    if hydrax_session is not None and not hydrax_session.closed:
+        await hydrax_session.close()
+    hydrax_session = None
+
+def build_multipart(file_name, file_type):
+    # Cabecera y cierre del cuerpo multipart; el contenido del archivo va en medio como stream
+    boundary = uuid.uuid4().hex
+    safe_name = file_name.replace('"', "%22").replace("\r", "").replace("\n", "")
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{safe_name}"\r\n'
+        f"Content-Type: {file_type}\r\n\r\n"
+    ).encode("utf-8")
+    tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+    return boundary, head, tail
+
+async def read_file_chunks(file_path, chunk_size=UPLOAD_CHUNK_SIZE):
+    # Lee el archivo por bloques en un hilo para no bloquear el event loop
+    f = await asyncio.to_thread(open, file_path, "rb")
     try:
-        with open(file_path, 'rb') as f:
-            files = {'file': (file_name, f, file_type)}
-            await progress_callback(0)
-            r = requests.post(url, files=files)
-            await progress_callback(100)
-            return r.text
-    except Exception as e:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+class HydraxError(Exception):
+    """Hydrax respondió con un estado HTTP de error o con una respuesta que no es una subida correcta."""
+
+    def __init__(self, status, text):
+        super().__init__(f"HTTP {status}: {text[:200]}")
+        self.status = status
+
+def check_hydrax_reply(status, text):
+    # Hydrax puede avisar de un error con HTTP 200: solo cuenta como subida (y se cachea) un JSON sin error
+    try:
+        reply = json.loads(text)
+    except ValueError:
+        reply = None
+    if not isinstance(reply, dict) or reply.get("status") is False or reply.get("error") or reply.get("errors"):
+        HYDRAX_ERRORS.inc(kind="bad_reply")
+        raise HydraxError(status, text)
+
+class SourceError(Exception):
+    """Falló el origen de los bytes (Telegram, la URL o el disco), no la conexión con Hydrax."""
+
+async def post_stream_to_hydrax(url, chunks, file_size, file_name, file_type, progress_callback):
+    """Envía `chunks` (iterador asíncrono de bytes) como multipart con Content-Length exacto.
+
+    Un fallo al leer `chunks` se relanza como SourceError: aiohttp lo envolvería en un error de conexión
+    y se confundiría con un fallo de la clave de Hydrax.
+    """
+    boundary, head, tail = build_multipart(file_name, file_type)
+    source_error = None
+
+    async def body():
+        nonlocal source_error
+        sent = 0
+        yield head
+        source = chunks.__aiter__()
+        while True:
+            try:
+                chunk = await source.__anext__()
+            except StopAsyncIteration:
+                break
+            except Exception as e:
+                source_error = e if isinstance(e, SourceError) else SourceError(f"{type(e).__name__}: {e}")
+                raise source_error from e
+            yield chunk
+            sent += len(chunk)
+            BYTES_TRANSFERRED.inc(len(chunk), direction="upload")
+            progress_callback(sent, file_size)
+        if sent != file_size:
+            # Aborta la petición: Hydrax esperaba exactamente file_size bytes
+            source_error = SourceError(f"Tamaño inesperado: {sent} de {file_size} bytes")
+            raise source_error
+        yield tail
+
+    headers = {
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+        "Content-Length": str(len(head) + file_size + len(tail)),
+    }
+    try:
+        async with get_hydrax_session().post(url, data=body(), headers=headers) as resp:
+            text = await resp.text()
+            if resp.status >= 400:
+                HYDRAX_ERRORS.inc(kind=f"http_{resp.status}")
+                raise HydraxError(resp.status, text)
+            check_hydrax_reply(resp.status, text)
+            return text
+    except SourceError:
+        raise
+    except Exception:
+        if source_error is not None:
+            raise source_error
+        raise
+
+# --- REPARTO DE SUBIDAS ENTRE CLAVES DE HYDRAX ---
+
+HYDRAX_RETRIES = int(os.getenv("HYDRAX_RETRIES", "4"))                        # intentos por subida desde disco
+HYDRAX_BREAKER_FAILURES = int(os.getenv("HYDRAX_BREAKER_FAILURES", "3"))      # fallos seguidos que abren el circuito de una clave
+HYDRAX_BREAKER_COOLDOWN = float(os.getenv("HYDRAX_BREAKER_COOLDOWN", "60"))   # segundos que se evita una clave con el circuito abierto
+
+def parse_hydrax_pool(spec):
+    """Claves (o URLs de subida completas) separadas por comas, espacios o saltos de línea."""
+    return [item for item in re.split(r"[\s,;]+", str(spec or "")) if item]
+
+class HydraxEndpoint:
+    """Una clave de Hydrax con su circuito (cerrado → abierto tras fallos seguidos → medio abierto tras la espera)."""
+
+    def __init__(self, entry):
+        self.url = entry if entry.startswith(("http://", "https://")) else f"{HYDRAX_URL}/{entry}"
+        # La clave la escribe el usuario en /hapi: la etiqueta solo lleva caracteres seguros para HTML y Prometheus
+        key = re.sub(r"[^A-Za-z0-9_.-]", "?", entry.rstrip("/").rsplit("/", 1)[-1])
+        self.label = key if len(key) <= 10 else f"{key[:4]}…{key[-4:]}"   # nunca se muestra la clave entera
+        self.active = 0         # subidas en curso
+        self.failures = 0       # fallos seguidos
+        self.open_until = 0.0   # monotónico; hasta entonces no se le envían subidas
+        self.probing = False    # con el circuito medio abierto solo pasa una subida de prueba
+        self.uploads = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def state(self, now=None):
+        now = time.monotonic() if now is None else now
+        if now < self.open_until:
+            return "open"
+        return "half_open" if self.failures >= HYDRAX_BREAKER_FAILURES else "closed"
+
+    def available(self, now):
+        state = self.state(now)
+        return state == "closed" or (state == "half_open" and not self.probing)
+
+    def record_success(self, size, elapsed):
+        if self.failures >= HYDRAX_BREAKER_FAILURES:
+            log_event(f"Clave de Hydrax {self.label} recuperada: circuito cerrado.")
+        self.failures = 0
+        self.uploads += 1
+        self.bytes += size
+        self.seconds += elapsed
+
+    def record_failure(self):
+        self.failures += 1
+        self.errors += 1
+        if self.failures >= HYDRAX_BREAKER_FAILURES:
+            self.open_until = time.monotonic() + HYDRAX_BREAKER_COOLDOWN
+            log_event(f"Clave de Hydrax {self.label}: {self.failures} fallos seguidos, circuito abierto {HYDRAX_BREAKER_COOLDOWN:.0f} s.",
+                      level="warning")
+
+class HydraxDispatcher:
+    """Reparte las subidas entre las claves de cada usuario (o las de HYDRAX_API_ID): elige la clave
+    disponible con menos subidas en curso, reintenta con backoff exponencial y evita las que tienen el circuito abierto.
+
+    El estado de cada clave es global, así que un fallo visto por un usuario aparta esa clave para todos.
+    """
+
+    def __init__(self):
+        self.endpoints = {}     # entrada de configuración: HydraxEndpoint
+
+    def pool(self, spec):
+        return [self.endpoints.setdefault(entry, HydraxEndpoint(entry)) for entry in parse_hydrax_pool(spec)]
+
+    def pick(self, pool, tried):
+        now = time.monotonic()
+        available = [ep for ep in pool if ep.available(now)]
+        candidates = [ep for ep in available if ep not in tried] or available
+        if not candidates:
+            # Todas con el circuito abierto: mejor la que antes se recupera que no subir
+            return min(pool, key=lambda ep: ep.open_until)
+        return min(candidates, key=lambda ep: (ep.active, ep.failures, ep.uploads + ep.errors))
+
+    async def post(self, endpoint, chunks, file_size, file_name, file_type, progress_callback):
+        if endpoint.state() == "half_open":
+            endpoint.probing = True
+        endpoint.active += 1
+        started = time.monotonic()
+        try:
+            result = await post_stream_to_hydrax(endpoint.url, chunks, file_size, file_name, file_type, progress_callback)
+        except (HydraxError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Solo cuenta contra la clave lo que falla en el lado de Hydrax; los SourceError se relanzan tal cual
+            if not isinstance(e, HydraxError):
+                HYDRAX_ERRORS.inc(kind=type(e).__name__)
+            endpoint.record_failure()
+            HYDRAX_KEY_UPLOADS.inc(key=endpoint.label, result="error")
+            raise
+        finally:
+            endpoint.active -= 1
+            endpoint.probing = False
+        endpoint.record_success(file_size, time.monotonic() - started)
+        HYDRAX_KEY_UPLOADS.inc(key=endpoint.label, result="ok")
+        HYDRAX_KEY_BYTES.inc(file_size, key=endpoint.label)
+        return result
+
+    async def upload_file(self, spec, file_path, file_name, file_type, progress_callback):
+        """Sube un archivo del disco; como el cuerpo se puede volver a leer, cada intento empieza de cero en otra clave."""
+        pool = self.pool(spec)
+        if not pool:
+            log_event(f"Sin clave de Hydrax configurada para subir {file_name}", level="error")
+            return None
+        file_size = os.path.getsize(file_path)
+        tried = set()
+        for attempt in range(HYDRAX_RETRIES):
+            endpoint = self.pick(pool, tried)
+            tried.add(endpoint)
+            progress_callback(0, file_size)
+            try:
+                return await self.post(endpoint, read_file_chunks(file_path), file_size, file_name, file_type, progress_callback)
+            except Exception as e:
+                log_event(f"Subida a Hydrax fallida con la clave {endpoint.label} ({file_name}), intento {attempt + 1}: {e}",
+                          level="warning")
+                # Una clave rechazada (4xx) no mejora reintentando si no hay otra a la que pasar
+                if isinstance(e, HydraxError) and 400 <= e.status < 500 and e.status != 429 and len(pool) == 1:
+                    break
+                if isinstance(e, SourceError):
+                    break   # el archivo local no se puede leer: otra clave no lo arregla
+                if attempt + 1 < HYDRAX_RETRIES:
+                    await asyncio.sleep(min(2 ** attempt, 60))
+        log_event(f"Error en subida a Hydrax ({file_name}): agotados los intentos", level="error")
+        return None
+
+    async def upload_stream(self, spec, chunks, file_size, file_name, file_type, progress_callback):
+        """Un único intento (el stream no se puede repetir): si falla, el llamador recurre al archivo temporal."""
+        pool = self.pool(spec)
+        if not pool:
+            return None
+        endpoint = self.pick(pool, set())
+        try:
+            progress_callback(0, file_size)
+            return await self.post(endpoint, chunks, file_size, file_name, file_type, progress_callback)
+        except Exception as e:
+            log_event(f"Error en pipeline a Hydrax con la clave {endpoint.label} ({file_name}): {e}", level="error")
+            return None
+
+    def stats(self):
+        now = time.monotonic()
+        return [
+            {"key": ep.label, "state": ep.state(now), "active": ep.active, "uploads": ep.uploads, "errors": ep.errors,
+             "bytes": ep.bytes, "speed": ep.bytes / ep.seconds if ep.seconds else 0.0}
+            for ep in self.endpoints.values()
+        ]
+
+hydrax_dispatcher = HydraxDispatcher()
+
+# --- CLIENTE HTTP COMPARTIDO PARA DESCARGAS Y VALIDACIONES ---
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))            # conexiones abiertas como máximo en total
+HTTP_PER_HOST = int(os.getenv("HTTP_PER_HOST", "16"))               # y por host (un mismo CDN reutiliza keep-alive)
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))                # segundos que se cachea cada resolución DNS
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "30"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "120"))    # segundos sin recibir datos antes de abortar
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))                  # intentos al abrir una petición
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024                                   # bloque inicial de lectura
+DOWNLOAD_CHUNK_MIN = 64 * 1024
+DOWNLOAD_CHUNK_MAX = int(os.getenv("DOWNLOAD_CHUNK_MAX", str(4 * 1024 * 1024)))
+DOWNLOAD_CHUNK_SECONDS = 0.25   # el bloque se ajusta para que cada lectura tarde más o menos esto
+
+http_session = None     # aiohttp.ClientSession compartida por todas las descargas y validaciones de enlaces
+
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_POOL_SIZE, limit_per_host=HTTP_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_TTL, keepalive_timeout=60,
+            ),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT),
+        )
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+def retry_delay(attempt, resp=None):
+    retry_after = resp.headers.get("Retry-After", "") if resp is not None else ""
+    if retry_after.isdigit():
+        return min(int(retry_after), 60)
+    return 2 ** attempt
+
+async def http_request(method, url, retries=HTTP_RETRIES, **kwargs):
+    """Abre una petición en la sesión compartida con reintentos (backoff exponencial) ante errores de conexión,
+    timeouts, 429 y 5xx. Devuelve la respuesta sin leer el cuerpo: úsala con `async with await http_request(...)`.
+    """
+    for attempt in range(retries):
+        resp = None
+        try:
+            resp = await get_http_session().request(method, url, **kwargs)
+            if resp.status not in HTTP_RETRY_STATUSES or attempt + 1 == retries:
+                return resp
+            resp.release()
+            reason = f"HTTP {resp.status}"
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt + 1 == retries:
+                raise
+            reason = type(e).__name__
+        delay = retry_delay(attempt, resp)
+        log_event(f"{method} {url} falló ({reason}), reintento {attempt + 1} en {delay} s", level="warning")
+        await asyncio.sleep(delay)
+
+async def http_get(url, **kwargs):
+    return await http_request("GET", url, **kwargs)
+
+async def iter_response(resp):
+    """Bloques del cuerpo con un tamaño que sigue a la velocidad medida: conexiones rápidas leen bloques
+    grandes (menos escrituras y menos vueltas por el event loop), lentas los leen pequeños (progreso fluido).
+    """
+    size = DOWNLOAD_CHUNK_SIZE
+    while True:
+        started = time.monotonic()
+        buf = bytearray()
+        while len(buf) < size:
+            data = await resp.content.read(size - len(buf))
+            if not data:
+                break
+            buf += data
+        if not buf:
+            return
+        yield bytes(buf)
+        if len(buf) < size:
+            return
+        rate = len(buf) / max(time.monotonic() - started, 1e-3)
+        target = rate * DOWNLOAD_CHUNK_SECONDS
+        # Potencias de dos, como mucho el doble o la mitad en cada paso
+        if target > size * 2:
+            size = min(size * 2, DOWNLOAD_CHUNK_MAX)
+        elif target < size / 2:
+            size = max(size // 2, DOWNLOAD_CHUNK_MIN)
+
+# --- PIPELINE DESCARGA → SUBIDA (SIN DISCO) ---
+
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "1") == "1"
+PIPELINE_BUFFER_CHUNKS = int(os.getenv("PIPELINE_BUFFER_CHUNKS", "8"))  # bloques en memoria (de hasta DOWNLOAD_CHUNK_MAX)
+
+async def telegram_chunks(file_id):
+    async for chunk in app.stream_media(file_id):
+        BYTES_TRANSFERRED.inc(len(chunk), direction="download")
+        yield chunk
+
+async def response_chunks(resp):
+    async for chunk in iter_response(resp):
+        BYTES_TRANSFERRED.inc(len(chunk), direction="download")
+        yield chunk
+
+async def pipe_chunks(source):
+    """Descarga y subida solapadas a través de un buffer acotado en memoria."""
+    queue = asyncio.Queue(maxsize=PIPELINE_BUFFER_CHUNKS)
+
+    async def producer():
+        try:
+            async for chunk in source:
+                await queue.put(chunk)
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+
+    task = asyncio.create_task(producer())
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+
+async def stream_to_hydrax(api_id, source, file_size, file_name, file_type, progress_callback):
+    chunks = pipe_chunks(source)
+    try:
+        return await hydrax_dispatcher.upload_stream(api_id, chunks, file_size, file_name, file_type, progress_callback)
+    finally:
+        # Si la subida falla a medias nadie agota el generador: se cierra aquí para cancelar su productor
+        await chunks.aclose()
+
+async def save_response(resp, local_path, progress_callback):
+    total = int(resp.headers.get('content-length', 0))
+    downloaded = 0
+    f = await asyncio.to_thread(open, local_path, "wb")
+    try:
+        if total:
+            await asyncio.to_thread(allocate_file, f, total)
+        async for chunk in iter_response(resp):
+            await asyncio.to_thread(f.write, chunk)
+            downloaded += len(chunk)
+            BYTES_TRANSFERRED.inc(len(chunk), direction="download")
+            progress_callback(downloaded, total)
+        if downloaded < total:
+            f.truncate(downloaded)
+    finally:
+        f.close()
+
+async def download_url(url, local_path, progress_callback, probe=None):
+    probe = probe or await probe_url(url)
+    if use_segments(local_path, probe):
+        try:
+            await download_segmented(url, local_path, probe["size"], probe["validator"], progress_callback)
+            return
+        except SegmentRestart as e:
+            # Lo descargado ya no sirve: se baja entero con un único GET
+            log_event(f"Descarga segmentada reiniciada ({local_path}): {e}", level="warning")
+    async with await http_get(url) as resp:
+        resp.raise_for_status()
+        await save_response(resp, local_path, progress_callback)
+
+# --- COLA PERSISTENTE DE TRABAJOS ---
+
+JOB_ACTIVE_STATES = ("queued", "running")
+
+def job_from_row(row):
+    return {
+        "id": row["id"],
+        "user_id": row["user_id"],
+        "chat_id": row["chat_id"],
+        "reply_to": row["reply_to"],
+        "status_msg_id": row["status_msg_id"],
+        "video_info": json.loads(row["video_info"]),
+        "batch_id": row["batch_id"],
+        "destination": row["destination"],
+        "created_at": row["created_at"],
+    }
+
+def job_source(video_info):
+    if isinstance(video_info, dict):
+        return "telegram", video_info["file_id"]
+    return "url", video_info
+
+async def create_job(user_id, chat_id, reply_to, video_info, destination="hydrax"):
+    now = time.time()
+    source_kind, source = job_source(video_info)
+
+    def insert():
+        with db_lock:
+            return db.execute(
+                "INSERT INTO jobs (user_id, chat_id, reply_to, source_kind, source, video_info, destination, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, chat_id, reply_to, source_kind, source, json.dumps(video_info), destination, now, now),
+            ).lastrowid
+
+    job_id = await asyncio.to_thread(insert)
+    return {"id": job_id, "user_id": user_id, "chat_id": chat_id, "reply_to": reply_to, "status_msg_id": None,
+            "video_info": video_info, "batch_id": None, "destination": destination, "created_at": now}
+
+async def update_job(job_id, **fields):
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    await db_run(f"UPDATE jobs SET {columns}, updated_at = ? WHERE id = ?", (*fields.values(), time.time(), job_id))
+
+async def cancel_jobs(job_ids):
+    # Solo los que siguen en espera: un worker de otro proceso puede haberlos reclamado ya
+    for job_id in job_ids:
+        await db_run("UPDATE jobs SET state = 'cancelled', updated_at = ? WHERE id = ? AND state = 'queued'", (time.time(), job_id))
+
+async def load_active_jobs():
+    rows = await db_run("SELECT * FROM jobs WHERE state IN (?, ?) ORDER BY id", JOB_ACTIVE_STATES)
+    return [job_from_row(row) for row in rows]
+
+async def prune_jobs():
+    await db_run("DELETE FROM jobs WHERE state NOT IN (?, ?) AND updated_at < ?", (*JOB_ACTIVE_STATES, time.time() - JOB_RETENTION))
+    await db_run("DELETE FROM batches WHERE state = 'done' AND created_at < ?", (time.time() - JOB_RETENTION,))
+
+# --- DESCARGAS HTTP SEGMENTADAS Y REANUDABLES ---
+
+DOWNLOAD_SEGMENTS = int(os.getenv("DOWNLOAD_SEGMENTS", "4"))                    # rangos en paralelo por archivo
+SEGMENT_MIN_SIZE = int(os.getenv("SEGMENT_MIN_SIZE", str(32 * 1024 * 1024)))    # por debajo, un solo GET
+SEGMENT_RETRIES = int(os.getenv("SEGMENT_RETRIES", "5"))
+SEGMENT_CHECKPOINT_INTERVAL = 2  # segundos entre guardados del estado de segmentos
+
+def url_temp_path(user_id, url, file_name):
+    # Ruta estable por usuario y URL para que un reintento encuentre la descarga parcial
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(TEMP_DIR, f"{user_id}_{digest}_{file_name}")
+
+def segment_state_path(local_path):
+    return local_path + ".parts"
+
+def write_json_atomic(filename, data):
+    tmp = filename + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, filename)
+
+class SegmentRestart(IOError):
+    """El servidor devolvió el archivo entero en vez del rango: cambió desde que empezó la descarga."""
+
+def load_segment_state(state_path, size, validator):
+    # Sin ETag ni Last-Modified no hay forma de saber si el archivo cambió: no se reanuda
+    if validator is None:
+        return None
+    try:
+        state = load_json(state_path, None)
+    except Exception:
         return None
+    if not state or state.get("size") != size or state.get("validator") != validator:
+        return None
+    return state
+
+def preallocate_file(path, size):
+    with open(path, "wb") as f:
+        allocate_file(f, size)
+
+def has_partial_download(local_path):
+    return os.path.exists(segment_state_path(local_path)) and os.path.exists(local_path)
+
+async def probe_url(url):
+    """Pide el primer byte: devuelve tamaño, validador (ETag/Last-Modified) y si se aceptan rangos."""
+    probe = {"size": 0, "validator": None, "ranges": False}
+    try:
+        async with await http_get(url, headers={"Range": "bytes=0-0"}) as resp:
+            if resp.status >= 400:
+                return probe
+            probe["validator"] = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+            if resp.status == 206:
+                total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+                if total.isdigit():
+                    probe["size"] = int(total)
+                    probe["ranges"] = True
+            else:
+                probe["size"] = int(resp.headers.get("content-length", 0))
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        pass
+    return probe
+
+def use_segments(local_path, probe):
+    return DOWNLOAD_SEGMENTS > 1 and probe["ranges"] and (probe["size"] >= SEGMENT_MIN_SIZE or has_partial_download(local_path))
+
+async def fetch_segment(url, fd, seg, validator, on_bytes):
+    # seg = [inicio, fin (inclusive), bytes ya escritos]; se reanuda desde inicio + escritos
+    start, end = seg[0], seg[1]
+    for attempt in range(SEGMENT_RETRIES):
+        if start + seg[2] > end:
+            return
+        headers = {"Range": f"bytes={start + seg[2]}-{end}"}
+        if validator:
+            headers["If-Range"] = validator
+        try:
+            async with get_http_session().get(url, headers=headers) as resp:
+                # 200 con If-Range = el validador ya no coincide; los errores HTTP se reintentan como los de red
+                resp.raise_for_status()
+                if resp.status != 206:
+                    raise SegmentRestart(f"el servidor no respetó el rango pedido (HTTP {resp.status})")
+                async for chunk in iter_response(resp):
+                    chunk = chunk[:end - start - seg[2] + 1]
+                    await asyncio.to_thread(os.pwrite, fd, chunk, start + seg[2])
+                    seg[2] += len(chunk)
+                    BYTES_TRANSFERRED.inc(len(chunk), direction="download")
+                    on_bytes(len(chunk))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt + 1 == SEGMENT_RETRIES:
+                raise
+            log_event(f"Segmento {start}-{end} interrumpido ({e}), reintento {attempt + 1}", level="warning")
+            await asyncio.sleep(2 ** attempt)
+    if start + seg[2] <= end:
+        raise IOError(f"Segmento {start}-{end} incompleto")
+
+async def download_segmented(url, local_path, size, validator, progress_callback):
+    """Descarga `size` bytes en DOWNLOAD_SEGMENTS rangos paralelos sobre un archivo preasignado.
 
-async def process_video_queue(user_id):
-    user_uploading[user_id] = True
-    while user_video_queue.get(user_id):
-        item = user_video_queue[user_id].pop(0)
-        message, video_info = item
-        lang = get_user_lang(user_id)
-        hydrax_api = user_hydrax_api.get(str(user_id), HYDRAX_API_ID)
-        await message.reply(t(user_id, "video_upload_start"))
-        local_path = None
-        file_name = None
-        file_type = None
-        temp_msg = await message.reply(t(user_id, "video_preparing"))
+    El estado de cada segmento se guarda en `<archivo>.parts`, así que un reintento
+    (o un reinicio del bot) continúa donde quedó en vez de empezar de cero.
+    """
+    state_path = segment_state_path(local_path)
+    state = load_segment_state(state_path, size, validator) if os.path.exists(local_path) else None
+    if state is None:
+        step = -(-size // DOWNLOAD_SEGMENTS)
+        state = {
+            "url": url,
+            "size": size,
+            "validator": validator,
+            "segments": [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)],
+        }
+        await asyncio.to_thread(preallocate_file, local_path, size)
+        await asyncio.to_thread(write_json_atomic, state_path, state)
+    else:
+        log_event(f"Reanudando descarga segmentada: {local_path}")
+    done = sum(seg[2] for seg in state["segments"])
+    progress_callback(done, size)
+
+    def on_bytes(n):
+        nonlocal done
+        done += n
+        progress_callback(done, size)
+
+    async def checkpoint():
+        while True:
+            await asyncio.sleep(SEGMENT_CHECKPOINT_INTERVAL)
+            await asyncio.to_thread(write_json_atomic, state_path, state)
+
+    fd = await asyncio.to_thread(os.open, local_path, os.O_RDWR)
+    saver = asyncio.create_task(checkpoint())
+    try:
+        results = await asyncio.gather(
+            *(fetch_segment(url, fd, seg, validator, on_bytes) for seg in state["segments"]),
+            return_exceptions=True,
+        )
+    finally:
+        saver.cancel()
+        os.close(fd)
+        await asyncio.to_thread(write_json_atomic, state_path, state)
+    restart = next((r for r in results if isinstance(r, SegmentRestart)), None)
+    if restart is not None:
+        os.remove(state_path)   # que ningún reintento reanude sobre datos de otra versión del archivo
+        raise restart
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    os.remove(state_path)
+
+# --- PRESUPUESTO DE DISCO PARA TEMP_DIR ---
+
+TEMP_BUDGET = int(os.getenv("TEMP_BUDGET", "0"))                              # bytes para temp/ (0 = espacio libre al arrancar)
+TEMP_MIN_FREE = int(os.getenv("TEMP_MIN_FREE", str(1024 * 1024 * 1024)))      # bytes que siempre se dejan libres en el disco
+TEMP_UNKNOWN_SIZE = int(os.getenv("TEMP_UNKNOWN_SIZE", str(512 * 1024 * 1024)))  # reserva si no se conoce el tamaño
+TEMP_PARTIAL_TTL = int(os.getenv("TEMP_PARTIAL_TTL", str(24 * 3600)))         # vida de las descargas parciales huérfanas
+
+class DiskBudgetExceeded(IOError):
+    """El archivo no cabe en el presupuesto de disco ni aunque terminen los demás trabajos."""
+
+def allocate_file(f, size):
+    # Reserva los bloques de verdad (posix_fallocate) para que un disco lleno falle aquí y no a mitad de descarga
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError) as e:
+        if isinstance(e, OSError) and e.errno == errno.ENOSPC:
+            raise
+        f.truncate(size)   # sistemas de archivos sin fallocate: archivo disperso
+
+def dir_size(path):
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file(follow_symlinks=False):
+            total += entry.stat().st_blocks * 512
+    return total
+
+class TempStorage:
+    """Contabilidad de bytes de TEMP_DIR: cada trabajo reserva el tamaño esperado antes de escribir en disco.
+
+    Si la reserva no cabe, el trabajo espera su turno (FIFO) hasta que otros liberen espacio,
+    en vez de llenar el disco y hacer fallar a todos.
+    """
+
+    def __init__(self, path, budget, min_free):
+        self.path = path
+        self.min_free = min_free
+        self.auto_budget = not budget
+        self.budget = budget or self.free_budget()
+        self.reservations = {}   # ruta: bytes reservados
+        self.waiters = deque()   # (ruta, bytes, bytes ya en disco, future) en orden de llegada
+        self.others = 0          # bytes reservados por otros workers en el mismo TEMP_DIR (según su último latido)
+
+    def free_budget(self):
+        # Por defecto: lo que ya ocupa temp/ más el espacio libre, menos el margen mínimo
+        return max(shutil.disk_usage(self.path).free + dir_size(self.path) - self.min_free, 0)
+
+    def reserved(self):
+        return sum(self.reservations.values())
+
+    def busy(self):
+        # Hay reservas que liberarán espacio tarde o temprano (propias o de otros workers)
+        return bool(self.reservations) or self.others > 0
+
+    def fits(self, size, on_disk=0):
+        if self.reserved() + self.others + size > self.budget:
+            return False
+        # Otros procesos también escriben en el disco: se comprueba el espacio libre real
+        return shutil.disk_usage(self.path).free - (size - on_disk) >= self.min_free
+
+    async def reserve(self, path, size, on_wait=None):
+        """Reserva `size` bytes para `path` (sustituye una reserva previa de la misma ruta)."""
+        previous = self.reservations.pop(path, None)
+        on_disk = os.path.getsize(path) if os.path.exists(path) else 0
+        if size > self.budget:
+            raise DiskBudgetExceeded(f"{format_bytes(size)} superan el presupuesto de {format_bytes(self.budget)}")
+        if not self.waiters and self.fits(size, on_disk):
+            self.reservations[path] = size
+            return
+        if not self.busy():
+            raise DiskBudgetExceeded(f"No hay {format_bytes(size)} libres en el disco")
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((path, size, on_disk, future))
+        if previous is not None:
+            self.wake()   # lo que liberó la reserva anterior puede servir a otro
+        if on_wait is not None:
+            on_wait()
         try:
-            # --- DESCARGA ---
-            if isinstance(video_info, dict):  # Telegram video/documento de tipo video
-                file_id = video_info["file_id"]
-                file_name = video_info.get("file_name", "video.mp4")
-                file_type = video_info.get("mime_type", "video/mp4")
-                local_path = os.path.join(TEMP_DIR, f"{int(time.time())}_{file_name}")
-                await app.download_media(file_id, file_name=local_path, progress=lambda cur, tot: asyncio.create_task(temp_msg.edit_text(f"{t(user_id, 'video_downloading')}\n{make_progress_bar(cur * 100 / tot if tot > 0 else 0)}")))
-            elif isinstance(video_info, str):  # URL directa
-                file_name = video_info.split("/")[-1]
-                file_type = "video/mp4" if file_name.endswith(".mp4") else "application/octet-stream"
-                local_path = os.path.join(TEMP_DIR, f"{user_id}_{int(time.time())}_{file_name}")
-                async with aiohttp.ClientSession() as sess:
-                    async with sess.get(video_info) as resp:
-                        with open(local_path, "wb") as f:
-                            downloaded = 0
-                            total = int(resp.headers.get('content-length', 0))
-                            async for chunk in resp.content.iter_chunked(1024*1024):
-                                f.write(chunk)
-                                downloaded += len(chunk)
-                                percent = downloaded * 100 / total if total else 0
-                                await temp_msg.edit_text(f"{t(user_id, 'video_downloading')}\n{make_progress_bar(percent)}")
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(path)
+            else:
+                self.waiters = deque(w for w in self.waiters if w[3] is not future)
+            raise
+
+    def release(self, path):
+        if self.reservations.pop(path, None) is not None:
+            self.wake()
+
+    def set_others(self, size):
+        self.others = size
+        self.wake()
+
+    def wake(self):
+        while self.waiters:
+            path, size, on_disk, future = self.waiters[0]
+            if future.done():
+                self.waiters.popleft()
+            elif self.fits(size, on_disk):
+                self.waiters.popleft()
+                self.reservations[path] = size
+                future.set_result(None)
+            elif not self.busy():
+                self.waiters.popleft()
+                future.set_exception(DiskBudgetExceeded(f"No hay {format_bytes(size)} libres en el disco"))
             else:
-                await temp_msg.edit_text(t(user_id, "video_error"))
+                break
+
+    def sweep(self, keep):
+        """Borra de TEMP_DIR lo que dejaron trabajos interrumpidos y devuelve (archivos, bytes) eliminados.
+
+        Se conservan los archivos de `keep` (trabajos activos) y las descargas segmentadas
+        reanudables (archivo + `.parts`) más recientes que TEMP_PARTIAL_TTL.
+        """
+        removed, freed = 0, 0
+        now = time.time()
+        keep = {os.path.abspath(p) for p in keep}
+        for entry in list(os.scandir(self.path)):
+            if not entry.is_file(follow_symlinks=False):
                 continue
+            path = os.path.abspath(entry.path)
+            # `.parts`: estado de una descarga segmentada; `.temp`: descarga en curso de Pyrogram
+            base = path.removesuffix(".parts").removesuffix(".temp")
+            if path in keep or base in keep:
+                continue
+            if os.path.exists(base + ".parts") and os.path.exists(base):
+                if now - os.path.getmtime(base + ".parts") < TEMP_PARTIAL_TTL:
+                    continue
+            try:
+                size = entry.stat().st_blocks * 512
+                os.remove(path)
+                removed += 1
+                freed += size
+            except OSError as e:
+                log_event(f"No se pudo borrar {path}: {e}", level="warning")
+        return removed, freed
 
-            # --- SUBIDA A HYDRAX ---
-            async def progress_callback(percent):
-                await temp_msg.edit_text(f"{t(user_id, 'video_uploading')}\n{make_progress_bar(percent)}")
+    async def start(self, sweep=True):
+        if sweep:
+            rows = await db_run(
+                "SELECT local_path FROM jobs WHERE state IN (?, ?) AND local_path IS NOT NULL", JOB_ACTIVE_STATES
+            )
+            removed, freed = await asyncio.to_thread(self.sweep, [row["local_path"] for row in rows])
+            if removed:
+                log_event(f"Limpieza de {self.path}: {removed} archivos huérfanos, {format_bytes(freed)} liberados")
+        if self.auto_budget:
+            self.budget = await asyncio.to_thread(self.free_budget)
+        log_event(f"Presupuesto de disco para {self.path}: {format_bytes(self.budget)}")
 
-            result = await upload_to_hydrax(hydrax_api, local_path, file_name, file_type, progress_callback)
-            if result:
-                await temp_msg.edit_text(f"{t(user_id, 'video_done')}\n{result}")
-                log_event(f"Video subido a Hydrax por {user_id}: {file_name}")
+    def usage(self):
+        return {
+            "budget": self.budget,
+            "reserved": self.reserved() + self.others,
+            "on_disk": dir_size(self.path),
+            "free": shutil.disk_usage(self.path).free,
+            "active": len(self.reservations),
+            "waiting": len(self.waiters),
+        }
+
+temp_storage = TempStorage(TEMP_DIR, TEMP_BUDGET, TEMP_MIN_FREE)
+
+async def reserve_temp(job, reporter, size):
+    """Reserva espacio para job["local_path"]; mientras espera, el mensaje de estado lo indica."""
+    await temp_storage.reserve(
+        job["local_path"], size or TEMP_UNKNOWN_SIZE,
+        on_wait=lambda: reporter.update("video_waiting_disk", 0, 0),
+    )
+
+# --- CACHÉ DE SUBIDAS (DEDUPLICACIÓN) ---
+
+CACHE_TTL = int(os.getenv("CACHE_TTL", str(30 * 24 * 3600)))           # segundos que vale un resultado
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "20000"))        # por encima se descartan los menos usados
+CACHE_CONTENT_HASH = os.getenv("CACHE_CONTENT_HASH", "0") == "1"        # además, clave por SHA-256 del contenido
+
+inflight_uploads = {}   # (scope, key): asyncio.Future con el resultado de la transferencia en curso
+
+def cache_scope(api_key):
+    # Los resultados solo se comparten entre trabajos que suben a la misma cuenta de Hydrax
+    return hashlib.sha1(str(api_key).encode("utf-8")).hexdigest()[:16]
+
+def normalize_url(url):
+    parts = urllib.parse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and (scheme, parts.port) not in (("http", 80), ("https", 443)):
+        host = f"{host}:{parts.port}"
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+    return urllib.parse.urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+def telegram_cache_key(video_info):
+    unique_id = video_info.get("file_unique_id")
+    return f"tg:{unique_id}" if unique_id else None
+
+def url_cache_key(url, probe):
+    # Sin tamaño ni validador no hay forma de saber si el archivo cambió detrás de la misma URL
+    if not probe["size"] and not probe["validator"]:
+        return None
+    return f"url:{normalize_url(url)}|{probe['validator'] or ''}|{probe['size']}"
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+async def hashed_chunks(chunks, hasher):
+    async for chunk in chunks:
+        await asyncio.to_thread(hasher.update, chunk)
+        yield chunk
+
+async def cache_get(scope, key):
+    rows = await db_run("SELECT result, created_at FROM upload_cache WHERE scope = ? AND key = ?", (scope, key))
+    if not rows:
+        return None
+    if rows[0]["created_at"] + CACHE_TTL < time.time():
+        await db_run("DELETE FROM upload_cache WHERE scope = ? AND key = ?", (scope, key))
+        return None
+    await db_run("UPDATE upload_cache SET last_used = ? WHERE scope = ? AND key = ?", (time.time(), scope, key))
+    return rows[0]["result"]
+
+async def cache_put(scope, keys, result):
+    now = time.time()
+
+    def write():
+        with db_lock:
+            db.execute("BEGIN")
+            db.executemany(
+                "INSERT OR REPLACE INTO upload_cache (scope, key, result, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                [(scope, key, result, now, now) for key in keys],
+            )
+            db.execute("DELETE FROM upload_cache WHERE created_at < ?", (now - CACHE_TTL,))
+            db.execute(
+                "DELETE FROM upload_cache WHERE rowid IN (SELECT rowid FROM upload_cache ORDER BY last_used "
+                "LIMIT max((SELECT COUNT(*) FROM upload_cache) - ?, 0))",
+                (CACHE_MAX_ENTRIES,),
+            )
+            db.execute("COMMIT")
+
+    await asyncio.to_thread(write)
+
+async def cached_or_claim(job, scope, key):
+    """Devuelve el resultado si ya está en caché o si un trabajo idéntico en curso lo obtiene.
+
+    Si no, reserva la clave para que los duplicados que lleguen mientras tanto esperen a este trabajo.
+    """
+    if key is None:
+        return None
+    result = await cache_get(scope, key)
+    while not result:
+        future = inflight_uploads.get((scope, key))
+        if future is None:
+            inflight_uploads[(scope, key)] = asyncio.get_running_loop().create_future()
+            job["claims"].append((scope, key))
+            return None
+        result = await asyncio.shield(future)
+    job["cache_hit"] = True
+    return result
+
+def release_claims(job, result):
+    for item in job["claims"]:
+        future = inflight_uploads.pop(item, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+    job["claims"] = []
+
+# --- TRANSFERENCIA DE TRABAJOS ---
+
+def url_file_info(url):
+    file_name = url.split("/")[-1]
+    file_type = "video/mp4" if file_name.endswith(".mp4") else "application/octet-stream"
+    return file_name, file_type
+
+async def upload_local_file(job, hydrax_api, scope, reporter, file_name, file_type):
+    if CACHE_CONTENT_HASH:
+        job["content_hash"] = await asyncio.to_thread(file_sha256, job["local_path"])
+        cached = await cached_or_claim(job, scope, f"sha256:{job['content_hash']}")
+        if cached:
+            return cached
+    return await hydrax_dispatcher.upload_file(hydrax_api, job["local_path"], file_name, file_type, reporter.callback("video_uploading"))
+
+async def stream_job_to_hydrax(job, hydrax_api, chunks, file_size, file_name, file_type, reporter):
+    hasher = hashlib.sha256() if CACHE_CONTENT_HASH else None
+    if hasher is not None:
+        chunks = hashed_chunks(chunks, hasher)
+    result = await stream_to_hydrax(hydrax_api, chunks, file_size, file_name, file_type, reporter.callback("video_streaming"))
+    if result and hasher is not None:
+        job["content_hash"] = hasher.hexdigest()
+    return result
+
+async def transfer_telegram(job, hydrax_api, scope, reporter):
+    video_info = job["video_info"]
+    file_id = video_info["file_id"]
+    file_name = video_info.get("file_name", "video.mp4")
+    file_type = video_info.get("mime_type", "video/mp4")
+    file_size = video_info.get("file_size", 0)
+    cached = await cached_or_claim(job, scope, telegram_cache_key(video_info))
+    if cached:
+        return cached
+    # --- PIPELINE: Telegram → Hydrax sin pasar por disco ---
+    if PIPELINE_MODE and file_size:
+        result = await stream_job_to_hydrax(job, hydrax_api, telegram_chunks(file_id), file_size, file_name, file_type, reporter)
+        if result:
+            return result
+    # --- DESCARGA A TEMP_DIR (tamaño desconocido o reintento) ---
+    job["local_path"] = os.path.join(TEMP_DIR, f"{job['id']}_{file_name}")
+    await update_job(job["id"], local_path=job["local_path"])
+    await reserve_temp(job, reporter, file_size)
+
+    downloaded = 0
+
+    async def telegram_progress(current, total):
+        nonlocal downloaded
+        BYTES_TRANSFERRED.inc(current - downloaded, direction="download")
+        downloaded = current
+        reporter.update("video_downloading", current, total)
+
+    await app.download_media(file_id, file_name=job["local_path"], progress=telegram_progress)
+    return await upload_local_file(job, hydrax_api, scope, reporter, file_name, file_type)
+
+async def transfer_url(job, hydrax_api, scope, reporter):
+    url = job["video_info"]
+    file_name, file_type = url_file_info(url)
+    local_path = job["local_path"] = url_temp_path(job["user_id"], url, file_name)
+    await update_job(job["id"], local_path=local_path)
+    download_callback = reporter.callback("video_downloading")
+    probe = await probe_url(url)
+    cached = await cached_or_claim(job, scope, url_cache_key(url, probe))
+    if cached:
+        return cached
+    # Archivos grandes con soporte de rangos: descarga segmentada (o reanudación) a disco
+    if use_segments(local_path, probe):
+        await reserve_temp(job, reporter, probe["size"])
+        await download_url(url, local_path, download_callback, probe)
+        return await upload_local_file(job, hydrax_api, scope, reporter, file_name, file_type)
+    if PIPELINE_MODE and probe["size"]:
+        async with await http_get(url) as resp:
+            resp.raise_for_status()
+            total = int(resp.headers.get('content-length', 0))
+            if total == probe["size"]:
+                result = await stream_job_to_hydrax(job, hydrax_api, response_chunks(resp), total, file_name, file_type, reporter)
+                if result:
+                    return result
+    # Tamaño desconocido, sin pipeline o con el stream ya consumido: copia completa en disco.
+    # El espacio se reserva antes de abrir la descarga para no retener una conexión mientras se espera.
+    await reserve_temp(job, reporter, probe["size"])
+    await download_url(url, local_path, download_callback)
+    return await upload_local_file(job, hydrax_api, scope, reporter, file_name, file_type)
+
+# --- DESTINO TELEGRAM ---
+
+TELEGRAM_SCOPE = "telegram"             # ámbito de la caché: file_id de lo que el bot ya subió a Telegram
+TELEGRAM_PART_SIZE = 512 * 1024         # tamaño de parte de MTProto (la última puede ser menor)
+TELEGRAM_BIG_FILE = 10 * 1024 * 1024    # a partir de aquí Telegram exige SaveBigFilePart
+TELEGRAM_MAX_UPLOAD = int(os.getenv("TELEGRAM_MAX_UPLOAD", str(2000 * 1024 * 1024)))   # límite de Telegram para bots
+TELEGRAM_UPLOAD_WORKERS = int(os.getenv("TELEGRAM_UPLOAD_WORKERS", "4"))            # partes subidas en paralelo
+TELEGRAM_PART_RETRIES = 3
+
+class TelegramTooBig(Exception):
+    pass
+
+def media_file_id(message):
+    media = message.video or message.document or message.animation if message else None
+    return media.file_id if media else None
+
+async def telegram_parts(chunks):
+    """Re-trocea los bloques de la descarga en partes de exactamente TELEGRAM_PART_SIZE."""
+    buf = bytearray()
+    async for chunk in chunks:
+        buf += chunk
+        while len(buf) >= TELEGRAM_PART_SIZE:
+            yield bytes(buf[:TELEGRAM_PART_SIZE])
+            del buf[:TELEGRAM_PART_SIZE]
+    if buf:
+        yield bytes(buf)
+
+telegram_media_session = None     # sesión MTProto de medios compartida por las subidas por partes
+telegram_media_lock = asyncio.Lock()
+
+async def get_media_session():
+    """Abre (una sola vez) una sesión de medios aparte, como hace save_file de Pyrogram.
+
+    Las partes no compiten así con los mensajes, ediciones de progreso y comandos que van por la sesión principal.
+    """
+    global telegram_media_session
+    async with telegram_media_lock:
+        if telegram_media_session is None:
+            session = Session(app, await app.storage.dc_id(), await app.storage.auth_key(),
+                              await app.storage.test_mode(), is_media=True)
+            await session.start()
+            telegram_media_session = session
+    return telegram_media_session
+
+async def close_media_session():
+    global telegram_media_session
+    if telegram_media_session is not None:
+        await telegram_media_session.stop()
+    telegram_media_session = None
+
+async def save_telegram_part(file_id, index, total_parts, big, data):
+    if big:
+        request = raw.functions.upload.SaveBigFilePart(file_id=file_id, file_part=index, file_total_parts=total_parts, bytes=data)
+    else:
+        request = raw.functions.upload.SaveFilePart(file_id=file_id, file_part=index, bytes=data)
+    for attempt in range(TELEGRAM_PART_RETRIES):
+        try:
+            session = await get_media_session()
+            if await session.invoke(request):
+                return
+        except FloodWait as e:
+            FLOOD_WAITS.inc(source="upload")
+            await asyncio.sleep(e.value)
+            continue
+        except (OSError, asyncio.TimeoutError) as e:
+            log_event(f"Parte {index} de la subida a Telegram interrumpida ({e}), reintento {attempt + 1}", level="warning")
+        await asyncio.sleep(2 ** attempt)
+    raise IOError(f"Telegram no aceptó la parte {index} de {total_parts}")
+
+async def upload_stream_to_telegram(chunks, file_size, file_name, progress_callback):
+    """Sube `chunks` a Telegram parte a parte, con TELEGRAM_UPLOAD_WORKERS partes en vuelo y sin copia en disco.
+
+    Devuelve el InputFile listo para enviarse con messages.SendMedia.
+    """
+    file_id = app.rnd_id()
+    total_parts = -(-file_size // TELEGRAM_PART_SIZE)
+    big = file_size > TELEGRAM_BIG_FILE
+    parts = asyncio.Queue(maxsize=TELEGRAM_UPLOAD_WORKERS * 2)
+    sent = 0
+
+    async def producer():
+        index = 0
+        async for part in telegram_parts(chunks):
+            if index >= total_parts:
+                raise IOError(f"Tamaño inesperado: más de {file_size} bytes")
+            await parts.put((index, part))
+            index += 1
+        if index != total_parts:
+            raise IOError(f"Tamaño inesperado: {index} de {total_parts} partes")
+        for _ in range(TELEGRAM_UPLOAD_WORKERS):
+            await parts.put(None)
+
+    async def worker():
+        nonlocal sent
+        while True:
+            item = await parts.get()
+            if item is None:
+                return
+            index, data = item
+            await save_telegram_part(file_id, index, total_parts, big, data)
+            sent += len(data)
+            BYTES_TRANSFERRED.inc(len(data), direction="upload")
+            progress_callback(sent, file_size)
+
+    tasks = [asyncio.create_task(producer())] + [asyncio.create_task(worker()) for _ in range(TELEGRAM_UPLOAD_WORKERS)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    if big:
+        return raw.types.InputFileBig(id=file_id, parts=total_parts, name=file_name)
+    return raw.types.InputFile(id=file_id, parts=total_parts, name=file_name, md5_checksum="")
+
+async def send_uploaded_video(job, input_file, file_name, file_type):
+    media = raw.types.InputMediaUploadedDocument(
+        file=input_file,
+        mime_type=file_type,
+        attributes=[
+            raw.types.DocumentAttributeVideo(duration=0, w=0, h=0, supports_streaming=True),
+            raw.types.DocumentAttributeFilename(file_name=file_name),
+        ],
+    )
+    r = await app.invoke(raw.functions.messages.SendMedia(
+        peer=await app.resolve_peer(job["chat_id"]),
+        media=media,
+        message="",
+        random_id=app.rnd_id(),
+        reply_to_msg_id=job["reply_to"],
+    ))
+    for update in r.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await types.Message._parse(app, update.message, {u.id: u for u in r.users}, {c.id: c for c in r.chats})
+    return None
+
+async def send_cached_retry(job, file_id):
+    for attempt in range(3):
+        try:
+            return await app.send_cached_media(job["chat_id"], file_id, reply_to_message_id=job["reply_to"])
+        except FloodWait as e:
+            FLOOD_WAITS.inc(source="job")
+            if attempt == 2:
+                raise
+            await asyncio.sleep(e.value)
+
+async def transfer_to_telegram(job, scope, reporter):
+    """Envía el archivo del trabajo al chat del usuario y devuelve el file_id del mensaje enviado.
+
+    Lo que ya está en Telegram se reenvía por file_id (sin descargar ni subir); una URL con tamaño conocido
+    se sube en streaming por partes, y solo sin tamaño (o si el streaming falla) se pasa por TEMP_DIR.
+    """
+    video_info = job["video_info"]
+    if isinstance(video_info, dict):
+        return media_file_id(await send_cached_retry(job, video_info["file_id"]))
+    url = video_info
+    probe = await probe_url(url)
+    cached = await cached_or_claim(job, scope, url_cache_key(url, probe))
+    if cached:
+        return media_file_id(await send_cached_retry(job, cached))
+    if probe["size"] > TELEGRAM_MAX_UPLOAD:
+        raise TelegramTooBig(f"{format_bytes(probe['size'])} supera el límite de Telegram")
+    file_name, file_type = url_file_info(url)
+    if PIPELINE_MODE and probe["size"]:
+        try:
+            async with await http_get(url) as resp:
+                resp.raise_for_status()
+                total = int(resp.headers.get("content-length", 0))
+                if total == probe["size"]:
+                    callback = reporter.callback("video_streaming_telegram")
+                    input_file = await upload_stream_to_telegram(response_chunks(resp), total, file_name, callback)
+                    return media_file_id(await send_uploaded_video(job, input_file, file_name, file_type))
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, RPCError) as e:
+            log_event(f"Error en pipeline a Telegram ({file_name}): {e}", level="error", job_id=job["id"])
+    # Tamaño desconocido o pipeline fallido: copia completa en disco y subida normal de Pyrogram
+    local_path = job["local_path"] = url_temp_path(job["user_id"], url, file_name)
+    await update_job(job["id"], local_path=local_path)
+    await reserve_temp(job, reporter, probe["size"])
+    await download_url(url, local_path, reporter.callback("video_downloading"))
+    if os.path.getsize(local_path) > TELEGRAM_MAX_UPLOAD:
+        raise TelegramTooBig(f"{format_bytes(os.path.getsize(local_path))} supera el límite de Telegram")
+    callback = reporter.callback("video_uploading_telegram")
+
+    async def progress(current, total):
+        callback(current, total)
+
+    message = await app.send_video(job["chat_id"], local_path, file_name=file_name, supports_streaming=True,
+                                   reply_to_message_id=job["reply_to"], progress=progress)
+    BYTES_TRANSFERRED.inc(os.path.getsize(local_path), direction="upload")
+    return media_file_id(message)
+
+async def send_message_retry(chat_id, text, retries=3, **kwargs):
+    # Los mensajes que abren un trabajo no pueden perderse por un FloodWait puntual
+    for attempt in range(retries):
+        try:
+            return await app.send_message(chat_id, text, **kwargs)
+        except FloodWait as e:
+            FLOOD_WAITS.inc(source="job")
+            if attempt + 1 == retries:
+                raise
+            await asyncio.sleep(e.value)
+
+def final_text(user_id, key, result):
+    # Un envío a Telegram no muestra el file_id: el archivo ya está en el chat
+    if key == "video_too_big_telegram":
+        return t(user_id, key).format(max=format_bytes(TELEGRAM_MAX_UPLOAD))
+    if result is None or key == "video_done_telegram":
+        return t(user_id, key)
+    return f"{t(user_id, key)}\n{result}"
+
+async def process_video_job(job):
+    job_id = job["id"]
+    user_id = job["user_id"]
+    chat_id = job["chat_id"]
+    video_info = job["video_info"]
+    to_telegram = job["destination"] == "telegram"
+    hydrax_api = user_hydrax_api.get(str(user_id), HYDRAX_API_ID)
+    scope = TELEGRAM_SCOPE if to_telegram else cache_scope(",".join(sorted(parse_hydrax_pool(hydrax_api))))
+    JOB_STAGE_SECONDS.observe(time.time() - job["created_at"], stage="queued")
+    await update_job(job_id, state="running")
+    # Un trabajo recuperado tras un reinicio reutiliza su mensaje de estado
+    # (en un worker separado los mensajes los crea y edita el frontend; los de un lote comparten un único mensaje)
+    if not job["status_msg_id"] and BOT_MODE != "worker" and not job["batch_id"]:
+        await send_message_retry(chat_id, t(user_id, "video_upload_start"), reply_to_message_id=job["reply_to"])
+        temp_msg = await send_message_retry(chat_id, t(user_id, "video_preparing"), reply_to_message_id=job["reply_to"])
+        job["status_msg_id"] = temp_msg.id
+        await update_job(job_id, status_msg_id=temp_msg.id)
+    job.update(local_path=None, claims=[], cache_hit=False, content_hash=None)
+    status_msg_id = None if BOT_MODE == "worker" or job["batch_id"] else job["status_msg_id"]
+    reporter = ProgressReporter(user_id, chat_id, status_msg_id, job_id=job_id)
+    reporter.start()
+    started = time.monotonic()
+    result = None
+    file_name = video_info.get("file_name") if isinstance(video_info, dict) else video_info
+
+    async def finish(state, key, result=None):
+        # La clave del mensaje final queda en `stage` para que el frontend lo muestre si el trabajo corrió en un worker
+        await reporter.finish(final_text(user_id, key, result))
+        await update_job(job_id, state=state, stage=key, result=result, notified=int(BOT_MODE != "worker"))
+
+    def job_fields():
+        # Campos estructurados comunes a las líneas de log del trabajo (filtrables con /log)
+        stage = reporter.stage.removeprefix("video_") if reporter.stage else None
+        return {"user_id": user_id, "job_id": job_id, "stage": stage, "bytes": reporter.total,
+                "duration": round(time.monotonic() - started, 3)}
+
+    try:
+        if to_telegram:  # reenvío por file_id o subida a Telegram
+            result = await transfer_to_telegram(job, scope, reporter)
+        elif isinstance(video_info, dict):  # Telegram video/documento de tipo video
+            result = await transfer_telegram(job, hydrax_api, scope, reporter)
+        elif isinstance(video_info, str):  # URL directa
+            result = await transfer_url(job, hydrax_api, scope, reporter)
+        # Las claves reclamadas (URL, tg:) se guardan también en un acierto por hash del contenido:
+        # así el siguiente envío del mismo enlace no vuelve a descargar el archivo para calcularlo
+        keys = [key for _, key in job["claims"]]
+        if result and job["content_hash"] and not job["cache_hit"]:
+            keys.append(f"sha256:{job['content_hash']}")
+        if result and keys:
+            await cache_put(scope, keys, result)
+        if result and job["cache_hit"]:
+            await finish("done", "video_done_telegram" if to_telegram else "video_done_cached", result)
+            JOBS_FINISHED.inc(result="cached")
+            log_event(f"Video de {user_id} servido desde caché: {file_name}", **job_fields())
+        elif result:
+            await finish("done", "video_done_telegram" if to_telegram else "video_done", result)
+            JOBS_FINISHED.inc(result="done")
+            log_event(f"Video subido a {job['destination']} por {user_id}: {file_name}", **job_fields())
+        else:
+            await finish("failed", "video_error")
+            JOBS_FINISHED.inc(result="failed")
+            log_event(f"Error subiendo a {job['destination']} para {user_id}: {file_name}", level="error", **job_fields())
+    except TelegramTooBig as e:
+        await finish("failed", "video_too_big_telegram")
+        JOBS_FINISHED.inc(result="failed")
+        log_event(f"Archivo demasiado grande para Telegram ({user_id}): {e}", level="warning", **job_fields())
+    except DiskBudgetExceeded as e:
+        await finish("failed", "video_too_big_for_disk")
+        JOBS_FINISHED.inc(result="failed")
+        log_event(f"Sin espacio en disco para el trabajo de {user_id}: {e}", level="warning", **job_fields())
+    except Exception as e:
+        await finish("failed", "video_error")
+        JOBS_FINISHED.inc(result="failed")
+        log_event(f"Excepción en subida para {user_id}: {e}", level="error", **job_fields())
+    finally:
+        JOB_STAGE_SECONDS.observe(time.time() - job["created_at"], stage="total")
+        # Los duplicados en espera reciben el resultado (o None para que lo intenten por su cuenta)
+        release_claims(job, result)
+        await reporter.close()
+        local_path = job["local_path"]
+        try:
+            # Una descarga segmentada incompleta se conserva para poder reanudarla
+            if local_path and os.path.exists(local_path) and not has_partial_download(local_path):
+                os.remove(local_path)
+        except Exception:
+            pass
+        if local_path:
+            temp_storage.release(local_path)
+
+# --- PLANIFICADOR GLOBAL DE SUBIDAS ---
+
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "4"))                 # trabajos simultáneos en todo el bot
+MAX_JOBS_PER_USER = int(os.getenv("MAX_JOBS_PER_USER", "1"))     # trabajos simultáneos por usuario
+MAX_PENDING_JOBS = int(os.getenv("MAX_PENDING_JOBS", "500"))     # tope de trabajos en espera (admisión)
+
+class UploadScheduler:
+    """Pool de workers compartido con turnos round-robin entre usuarios y prioridad para el creador."""
+
+    def __init__(self, workers, per_user, max_pending):
+        self.workers = workers
+        self.per_user = per_user
+        self.max_pending = max_pending
+        self.queues = {}        # user_id: deque de trabajos pendientes
+        self.running = {}       # user_id: nº de trabajos en curso
+        self.order = deque()    # turno round-robin de usuarios con trabajos pendientes
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+
+    def pending_count(self, user_id=None):
+        if user_id is not None:
+            return len(self.queues.get(user_id, ()))
+        return sum(len(q) for q in self.queues.values())
+
+    def running_count(self, user_id=None):
+        if user_id is not None:
+            return self.running.get(user_id, 0)
+        return sum(self.running.values())
+
+    def position(self, user_id):
+        # Posición aproximada del último trabajo del usuario: cada otro usuario consume un turno por cada uno suyo
+        mine = self.pending_count(user_id)
+        if user_id == CREATOR_ID:
+            return mine
+        ahead = self.pending_count(CREATOR_ID)
+        for uid, q in self.queues.items():
+            if uid not in (user_id, CREATOR_ID):
+                ahead += min(len(q), mine)
+        return ahead + mine
+
+    def is_full(self):
+        return self.pending_count() >= self.max_pending
+
+    def submit(self, job):
+        """Encola un trabajo ya persistido. Devuelve 0 si arranca ya o su posición en la cola."""
+        user_id = job["user_id"]
+        starts_now = (
+            self.running_count() + self.pending_count() < self.workers
+            and self.running_count(user_id) < self.per_user
+            and not self.queues.get(user_id)
+        )
+        queue = self.queues.setdefault(user_id, deque())
+        queue.append(job)
+        if user_id != CREATOR_ID and len(queue) == 1:
+            self.order.append(user_id)
+        self.wakeup.set()
+        return 0 if starts_now else self.position(user_id)
+
+    def pick(self):
+        creator_queue = self.queues.get(CREATOR_ID)
+        if creator_queue and self.running_count(CREATOR_ID) < self.per_user:
+            job = creator_queue.popleft()
+            if not creator_queue:
+                del self.queues[CREATOR_ID]
+            return job
+        for _ in range(len(self.order)):
+            uid = self.order.popleft()
+            queue = self.queues.get(uid)
+            if not queue:
+                continue
+            self.order.append(uid)
+            if self.running_count(uid) >= self.per_user:
+                continue
+            job = queue.popleft()
+            if not queue:
+                self.order.remove(uid)
+                del self.queues[uid]
+            return job
+        return None
+
+    def cancel_user(self, user_id):
+        queue = self.queues.pop(user_id, None)
+        if user_id in self.order:
+            self.order.remove(user_id)
+        return list(queue) if queue else []
+
+    async def worker(self):
+        while True:
+            job = self.pick()
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            user_id = job["user_id"]
+            self.running[user_id] = self.running.get(user_id, 0) + 1
+            try:
+                await process_video_job(job)
+            except Exception as e:
+                log_event(f"Excepción en worker para {user_id}: {e}", level="error", user_id=user_id, job_id=job["id"])
+                await update_job(job["id"], state="failed")
+            finally:
+                self.running[user_id] -= 1
+                if not self.running[user_id]:
+                    del self.running[user_id]
+                # Un hueco por usuario liberado puede desbloquear trabajos en espera
+                self.wakeup.set()
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+# --- MODO MULTIPROCESO: FRONTEND DE TELEGRAM + PROCESOS WORKER ---
+
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0"))              # workers que lanza el propio frontend (0 = se arrancan aparte)
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "1"))     # segundos entre intentos de reclamar trabajo
+WORKER_HEARTBEAT = float(os.getenv("WORKER_HEARTBEAT", "5"))             # segundos entre latidos de cada worker
+WORKER_TIMEOUT = float(os.getenv("WORKER_TIMEOUT", "60"))                # sin latido en este tiempo, sus trabajos se reencolan
+WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", "600"))   # espera máxima a los trabajos en curso al apagar
+JOB_FINAL_MESSAGES = ("video_done", "video_done_cached", "video_done_telegram", "video_error", "video_too_big_for_disk",
+                      "video_too_big_telegram")
+
+# Reclamación atómica entre procesos: prioridad al creador, luego el usuario atendido hace más tiempo
+# (round-robin) y dentro de cada usuario el trabajo más antiguo; respeta MAX_JOBS_PER_USER en todo el sistema
+CLAIM_JOB_SQL = """
+UPDATE jobs SET state = 'running', worker = :worker, claimed_at = :now, updated_at = :now
+WHERE state = 'queued' AND id = (
+    SELECT j.id FROM jobs j
+    WHERE j.state = 'queued'
+      AND (SELECT COUNT(*) FROM jobs r WHERE r.user_id = j.user_id AND r.state = 'running') < :per_user
+    ORDER BY j.user_id = :creator DESC,
+             (SELECT MAX(c.claimed_at) FROM jobs c WHERE c.user_id = j.user_id) IS NOT NULL,
+             (SELECT MAX(c.claimed_at) FROM jobs c WHERE c.user_id = j.user_id),
+             j.id
+    LIMIT 1
+)
+RETURNING *
+"""
+
+def claim_job(worker_id, per_user):
+    with db_lock:
+        rows = db.execute(CLAIM_JOB_SQL, {"worker": worker_id, "now": time.time(), "per_user": per_user, "creator": CREATOR_ID}).fetchall()
+    return job_from_row(rows[0]) if rows else None
+
+async def requeue_worker_jobs(worker_id):
+    rows = await db_run(
+        "UPDATE jobs SET state = 'queued', worker = NULL, updated_at = ? WHERE worker = ? AND state = 'running' RETURNING id",
+        (time.time(), worker_id),
+    )
+    return len(rows)
+
+class JobWorker:
+    """Proceso de transferencias (BOT_MODE=worker): reclama trabajos de la cola compartida en bot.db y los ejecuta.
+
+    Cada reclamación es un único UPDATE atómico, así que se pueden arrancar tantos procesos como núcleos haya.
+    El progreso se guarda en la tabla jobs y el frontend es quien lo muestra en Telegram.
+    """
+
+    def __init__(self, worker_id, slots, per_user):
+        self.id = worker_id
+        self.slots = slots
+        self.per_user = per_user
+        self.draining = False
+        self.current = {}   # job_id: trabajo en curso
+        self.tasks = []
+        self.beat = None
+
+    async def heartbeat(self):
+        now = time.time()
+        await db_run(
+            "INSERT OR REPLACE INTO workers (id, pid, slots, state, heartbeat, stats) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.id, os.getpid(), self.slots, "draining" if self.draining else "running", now, json.dumps(metrics_snapshot())),
+        )
+        # TEMP_DIR es compartido: lo que reservan los demás workers cuenta contra el mismo presupuesto
+        rows = await db_run("SELECT stats FROM workers WHERE id != ? AND heartbeat > ? AND stats IS NOT NULL",
+                            (self.id, now - WORKER_TIMEOUT))
+        temp_storage.set_others(sum(json.loads(row["stats"])["temp"]["reserved"] for row in rows))
+
+    async def heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                log_event(f"Error registrando el latido del worker {self.id}: {e}", level="error")
+
+    async def slot(self):
+        while not self.draining:
+            try:
+                job = await asyncio.to_thread(claim_job, self.id, self.per_user)
+            except Exception as e:
+                # p. ej. "database is locked" con muchos workers: el hueco no se pierde, solo espera
+                log_event(f"Error reclamando trabajo en el worker {self.id}: {e}", level="error")
+                await asyncio.sleep(WORKER_POLL_INTERVAL * 5)
+                continue
+            if job is None:
+                await asyncio.sleep(WORKER_POLL_INTERVAL)
+                continue
+            self.current[job["id"]] = job
+            try:
+                # La API de Hydrax de cada usuario la cambia el frontend: se relee antes de cada trabajo
+                user_hydrax_api.replace(await asyncio.to_thread(user_hydrax_api.fetch))
+                await process_video_job(job)
+            except Exception as e:
+                log_event(f"Excepción en worker {self.id}: {e}", level="error", user_id=job["user_id"], job_id=job["id"])
+                await update_job(job["id"], state="failed", stage="video_error", notified=0)
+            finally:
+                self.current.pop(job["id"], None)
+
+    async def start(self):
+        # Lo que este mismo worker dejó a medias si se cayó vuelve a la cola
+        requeued = await requeue_worker_jobs(self.id)
+        if requeued:
+            log_event(f"Worker {self.id}: {requeued} trabajos a medias devueltos a la cola.")
+        await self.heartbeat()
+        self.beat = asyncio.create_task(self.heartbeat_loop())
+        self.tasks = [asyncio.create_task(self.slot()) for _ in range(self.slots)]
+        log_event(f"Worker {self.id} iniciado con {self.slots} huecos (pid {os.getpid()}).")
+
+    async def stop(self):
+        """Deja de reclamar trabajos y espera, como mucho WORKER_DRAIN_TIMEOUT, a que terminen los que están en curso."""
+        self.draining = True
+        await self.heartbeat()
+        log_event(f"Worker {self.id} vaciándose: {len(self.current)} trabajos en curso.")
+        pending = set()
+        if self.tasks:
+            _, pending = await asyncio.wait(self.tasks, timeout=WORKER_DRAIN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        # Lo que no terminó a tiempo lo retoma otro worker
+        requeued = await requeue_worker_jobs(self.id)
+        if requeued:
+            log_event(f"Worker {self.id}: {requeued} trabajos sin terminar devueltos a la cola.", level="warning")
+        self.beat.cancel()
+        await db_run("DELETE FROM workers WHERE id = ?", (self.id,))
+        self.tasks = []
+
+class SharedJobQueue(UploadScheduler):
+    """Cola del frontend (BOT_MODE=frontend): los trabajos se guardan en bot.db y los ejecutan procesos worker.
+
+    Mantiene una instantánea de la cola para las posiciones, la admisión, /cancel y /stats, reencola
+    los trabajos de workers caídos y dibuja en Telegram el progreso que los workers guardan en la base de datos.
+    """
+
+    def __init__(self, per_user, max_pending, processes):
+        super().__init__(0, per_user, max_pending)   # `workers` = huecos de los workers vivos
+        self.processes = processes
+        self.alive = 0          # workers con latido reciente
+        self.reporters = {}     # job_id: ProgressReporter de su mensaje de estado
+        self.children = {}      # worker_id: proceso worker lanzado por este frontend
+
+    async def requeue_stale(self):
+        now = time.time()
+        rows = await db_run(
+            "SELECT * FROM jobs WHERE state = 'running' AND worker IS NOT NULL "
+            "AND worker NOT IN (SELECT id FROM workers WHERE heartbeat > ?)",
+            (now - WORKER_TIMEOUT,),
+        )
+        for row in rows:
+            # Condicionado al mismo worker: si entretanto terminó o lo reclamó otro, no se toca
+            updated = await db_run(
+                "UPDATE jobs SET state = 'queued', worker = NULL, updated_at = ? WHERE id = ? AND state = 'running' AND worker = ? RETURNING id",
+                (now, row["id"], row["worker"]),
+            )
+            if not updated:
+                continue
+            log_event(f"Trabajo {row['id']} reencolado: su worker {row['worker']} no responde.", level="warning",
+                      user_id=row["user_id"], job_id=row["id"])
+            if row["status_msg_id"]:
+                try:
+                    await app.edit_message_text(row["chat_id"], row["status_msg_id"], t(row["user_id"], "video_resumed"))
+                except Exception:
+                    pass
+
+    async def render_running(self, job, row):
+        user_id = job["user_id"]
+        if not job["status_msg_id"]:
+            await send_message_retry(job["chat_id"], t(user_id, "video_upload_start"), reply_to_message_id=job["reply_to"])
+            temp_msg = await send_message_retry(job["chat_id"], t(user_id, "video_preparing"), reply_to_message_id=job["reply_to"])
+            job["status_msg_id"] = temp_msg.id
+            await update_job(job["id"], status_msg_id=temp_msg.id)
+        reporter = self.reporters.get(job["id"])
+        if reporter is None:
+            reporter = self.reporters[job["id"]] = ProgressReporter(user_id, job["chat_id"], job["status_msg_id"], timed=False)
+        if row["stage"]:
+            reporter.update(row["stage"], row["bytes_done"], row["bytes_total"])
+            await reporter.flush()
+
+    async def render_final(self, job, row):
+        user_id = job["user_id"]
+        key = row["stage"] if row["stage"] in JOB_FINAL_MESSAGES else ("video_done" if row["state"] == "done" else "video_error")
+        text = final_text(user_id, key, row["result"])
+        reporter = self.reporters.pop(job["id"], None)
+        if job["batch_id"]:
+            pass    # el resumen lo publica el seguimiento del lote
+        elif job["status_msg_id"]:
+            reporter = reporter or ProgressReporter(user_id, job["chat_id"], job["status_msg_id"], timed=False)
+            await reporter.finish(text)
+        else:
+            await send_message_retry(job["chat_id"], text, reply_to_message_id=job["reply_to"])
+        await update_job(job["id"], notified=1)
+        JOBS_FINISHED.inc(result={"video_done": "done", "video_done_telegram": "done", "video_done_cached": "cached"}.get(key, "failed"))
+
+    async def refresh(self):
+        await self.requeue_stale()
+        alive = await db_run(
+            "SELECT COUNT(*) AS n, COALESCE(SUM(slots), 0) AS slots FROM workers WHERE heartbeat > ? AND state = 'running'",
+            (time.time() - WORKER_TIMEOUT,),
+        )
+        self.alive, self.workers = alive[0]["n"], alive[0]["slots"]
+        rows = await db_run(
+            "SELECT * FROM jobs WHERE state IN ('queued', 'running') OR (state IN ('done', 'failed') AND notified = 0) ORDER BY id"
+        )
+        queues, running, renders, seen = {}, {}, [], set()
+        for row in rows:
+            job = job_from_row(row)
+            seen.add(job["id"])
+            if row["state"] == "queued":
+                queues.setdefault(job["user_id"], deque()).append(job)
+            elif row["state"] == "running":
+                running[job["user_id"]] = running.get(job["user_id"], 0) + 1
+                if not job["batch_id"]:
+                    renders.append(self.render_running(job, row))
             else:
-                await temp_msg.edit_text(t(user_id, "video_error"))
-                log_event(f"Error subiendo a Hydrax para {user_id}: {file_name}")
-        except Exception as e:
-            await temp_msg.edit_text(t(user_id, "video_error"))
-            log_event(f"Excepción en subida para {user_id}: {e}")
-        finally:
+                renders.append(self.render_final(job, row))
+        self.queues, self.running = queues, running
+        self.order = deque(uid for uid in queues if uid != CREATOR_ID)
+        for job_id in [job_id for job_id in self.reporters if job_id not in seen]:
+            await self.reporters.pop(job_id).close()   # cancelado o retirado de la cola
+        for result in await asyncio.gather(*renders, return_exceptions=True):
+            if isinstance(result, Exception):
+                log_event(f"Error mostrando el progreso de un trabajo: {result}", level="error")
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                log_event(f"Error leyendo la cola compartida: {e}", level="error")
+            await asyncio.sleep(PROGRESS_INTERVAL)
+
+    async def supervise(self, worker_id):
+        env = {**os.environ, "BOT_MODE": "worker", "WORKER_ID": worker_id}
+        while True:
+            proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+            self.children[worker_id] = proc
+            code = await proc.wait()
+            log_event(f"El worker {worker_id} terminó (código {code}); se relanza en 5 s.", level="warning")
+            await asyncio.sleep(5)
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.run())]
+        self.tasks += [asyncio.create_task(self.supervise(f"local-{i + 1}")) for i in range(self.processes)]
+
+    async def stop(self):
+        await super().stop()
+        # SIGTERM: cada worker deja de reclamar trabajos y termina los que tiene en curso antes de salir
+        for proc in self.children.values():
+            if proc.returncode is None:
+                proc.terminate()
+        for worker_id, proc in self.children.items():
+            try:
+                await asyncio.wait_for(proc.wait(), WORKER_DRAIN_TIMEOUT + 30)
+            except asyncio.TimeoutError:
+                log_event(f"El worker {worker_id} no terminó a tiempo; se fuerza su cierre.", level="warning")
+                proc.kill()
+                await proc.wait()
+        self.children.clear()
+        for reporter in self.reporters.values():
+            await reporter.close()
+
+if BOT_MODE == "frontend":
+    scheduler = SharedJobQueue(MAX_JOBS_PER_USER, MAX_PENDING_JOBS, WORKER_PROCESSES)
+else:
+    scheduler = UploadScheduler(MAX_WORKERS, MAX_JOBS_PER_USER, MAX_PENDING_JOBS)
+
+UPLOAD_DESTINATIONS = ("hydrax", "telegram")
+
+def user_destination(user_id):
+    return user_server.get(str(user_id), "hydrax")
+
+async def enqueue_video(message, video_info):
+    user_id = message.from_user.id
+    if scheduler.is_full():
+        await message.reply(t(user_id, "queue_full"))
+        log_event(f"Cola llena: rechazado trabajo de {user_id}", level="warning", user_id=user_id)
+        return
+    job = await create_job(user_id, message.chat.id, message.id, video_info, user_destination(user_id))
+    position = scheduler.submit(job)
+    if position:
+        await message.reply(t(user_id, "video_queued_position").format(position=position))
+
+async def recover_jobs():
+    """Vuelve a encolar los trabajos que quedaron pendientes o a medias antes del último apagado."""
+    await prune_jobs()
+    jobs = await load_active_jobs()
+    for job in jobs:
+        scheduler.submit(job)
+        if job["status_msg_id"]:
             try:
-                if local_path and os.path.exists(local_path):
-                    os.remove(local_path)
+                await app.edit_message_text(job["chat_id"], job["status_msg_id"], t(job["user_id"], "video_resumed"))
+            except Exception as e:
+                log_event(f"No se pudo reanudar el mensaje de estado del trabajo {job['id']}: {e}", level="warning", job_id=job["id"])
+    if jobs:
+        log_event(f"Recuperados {len(jobs)} trabajos pendientes tras el reinicio.")
+
+# --- INGESTA MASIVA: VARIOS ENLACES, ARCHIVOS .txt/.csv Y ÁLBUMES ---
+
+PROBE_CONCURRENCY = int(os.getenv("PROBE_CONCURRENCY", "8"))        # validaciones HEAD simultáneas
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", "15"))             # segundos máximos por validación
+PROBE_TTL = float(os.getenv("PROBE_TTL", "300"))                    # vida de un resultado en la caché de validaciones
+BATCH_MAX_URLS = int(os.getenv("BATCH_MAX_URLS", "500"))            # enlaces como máximo por envío
+LINK_FILE_MAX_BYTES = int(os.getenv("LINK_FILE_MAX_BYTES", str(1024 * 1024)))
+MEDIA_GROUP_WAIT = 1.5      # segundos que se esperan las demás partes de un álbum
+BATCH_RESULTS_INLINE = 3500 # por encima, los resultados del lote se envían como documento
+
+URL_PATTERN = re.compile(r"https?://[^\s,;\"'<>]+", re.IGNORECASE)
+NON_VIDEO_TYPES = ("text/", "image/", "audio/", "application/json", "application/xml", "application/javascript")
+
+url_probes = {}         # URL normalizada: (caducidad monotónica, resultado de validate_url)
+media_groups = {}       # media_group_id: (primer mensaje, lista de video_info)
+batch_tasks = {}        # batch_id: asyncio.Task que sigue el progreso del lote
+
+def extract_urls(text):
+    """URLs http(s) de un texto (una por línea, o separadas por comas/espacios en un .csv), sin duplicados."""
+    urls, seen = [], set()
+    for match in URL_PATTERN.findall(text or ""):
+        url = match.rstrip(").]}>")
+        key = normalize_url(url)
+        if key not in seen:
+            seen.add(key)
+            urls.append(url)
+    return urls
+
+def is_link_file(document):
+    name = (document.file_name or "").lower()
+    return name.endswith((".txt", ".csv")) or (document.mime_type or "") in ("text/plain", "text/csv")
+
+def probe_verdict(url, status, headers):
+    if status >= 400:
+        return {"ok": False, "reason": "probe_http", "detail": status, "size": 0}
+    if status == 206:
+        total = headers.get("Content-Range", "").rpartition("/")[2]
+        size = int(total) if total.isdigit() else 0
+    else:
+        size = int(headers.get("Content-Length", 0) or 0)
+    content_type = headers.get("Content-Type", "").split(";")[0].strip().lower()
+    if content_type.startswith(NON_VIDEO_TYPES):
+        return {"ok": False, "reason": "probe_not_video", "detail": content_type, "size": size}
+    if "Content-Length" in headers and size == 0 and status != 206:
+        return {"ok": False, "reason": "probe_empty", "detail": None, "size": 0}
+    # video/*, o binario genérico: se acepta si la extensión lo confirma o si el servidor lo sirve como descarga
+    path = urllib.parse.urlsplit(url).path.lower()
+    if not content_type.startswith("video/") and not path.endswith(VIDEO_EXTENSIONS) and not size:
+        return {"ok": False, "reason": "probe_not_video", "detail": content_type or "?", "size": 0}
+    return {"ok": True, "reason": None, "detail": None, "size": size}
+
+async def validate_url(url):
+    """Comprueba con HEAD (o un GET del primer byte si el servidor no acepta HEAD) que la URL sirve un video."""
+    key = normalize_url(url)
+    cached = url_probes.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    probe_timeout = aiohttp.ClientTimeout(total=PROBE_TIMEOUT)
+    try:
+        async with await http_request("HEAD", url, allow_redirects=True, timeout=probe_timeout) as resp:
+            status, headers = resp.status, resp.headers
+        if status in (403, 405, 501):
+            async with await http_get(url, headers={"Range": "bytes=0-0"}, timeout=probe_timeout) as resp:
+                status, headers = resp.status, resp.headers
+        verdict = probe_verdict(url, status, headers)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        verdict = {"ok": False, "reason": "probe_network", "detail": type(e).__name__, "size": 0}
+    url_probes[key] = (time.monotonic() + PROBE_TTL, verdict)
+    if len(url_probes) > 4 * BATCH_MAX_URLS:
+        now = time.monotonic()
+        for stale in [k for k, (expires, _) in url_probes.items() if expires <= now]:
+            del url_probes[stale]
+    return verdict
+
+async def validate_urls(urls):
+    """Valida todas las URLs en paralelo, como mucho PROBE_CONCURRENCY a la vez."""
+    limit = asyncio.Semaphore(PROBE_CONCURRENCY)
+
+    async def one(url):
+        async with limit:
+            return await validate_url(url)
+
+    return await asyncio.gather(*(one(url) for url in urls))
+
+def probe_reason(user_id, verdict):
+    return t(user_id, verdict["reason"]).format(detail=verdict["detail"])
+
+async def create_batch(user_id, chat_id, reply_to, status_msg_id, items, rejected, destination="hydrax"):
+    """Guarda el lote y todos sus trabajos en una sola transacción y devuelve (batch_id, trabajos)."""
+    now = time.time()
+
+    def insert():
+        with db_lock:
+            db.execute("BEGIN")
+            try:
+                batch_id = db.execute(
+                    "INSERT INTO batches (user_id, chat_id, status_msg_id, total, rejected, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_id, chat_id, status_msg_id, len(items), json.dumps(rejected), now),
+                ).lastrowid
+                jobs = []
+                for video_info in items:
+                    source_kind, source = job_source(video_info)
+                    job_id = db.execute(
+                        "INSERT INTO jobs (user_id, chat_id, reply_to, source_kind, source, video_info, batch_id, destination, "
+                        "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (user_id, chat_id, reply_to, source_kind, source, json.dumps(video_info), batch_id, destination, now, now),
+                    ).lastrowid
+                    jobs.append({"id": job_id, "user_id": user_id, "chat_id": chat_id, "reply_to": reply_to, "status_msg_id": None,
+                                 "video_info": video_info, "batch_id": batch_id, "destination": destination, "created_at": now})
+                db.execute("COMMIT")
             except Exception:
-                pass
-        await asyncio.sleep(1)
-    user_uploading[user_id] = False
+                db.execute("ROLLBACK")
+                raise
+            return batch_id, jobs
+
+    return await asyncio.to_thread(insert)
+
+async def enqueue_batch(message, items, rejected=(), status_msg=None):
+    """Encola varios archivos como un lote con un único mensaje de progreso agregado."""
+    user_id = message.from_user.id
+    rejected = list(rejected)
+    if not items:
+        text = t(user_id, "batch_none_valid") + "".join(f"\n• {url} — {reason}" for url, reason in rejected[:20])
+        # Las URL van tal cual: sin formato, para que ni _ ni < las deformen
+        if status_msg:
+            await status_msg.edit_text(text, parse_mode=enums.ParseMode.DISABLED, disable_web_page_preview=True)
+        else:
+            await message.reply(text, parse_mode=enums.ParseMode.DISABLED, disable_web_page_preview=True)
+        return
+    if scheduler.pending_count() + len(items) > scheduler.max_pending:
+        await message.reply(t(user_id, "queue_full"))
+        log_event(f"Cola llena: rechazado lote de {len(items)} trabajos de {user_id}", level="warning", user_id=user_id)
+        return
+    if status_msg is None:
+        status_msg = await message.reply(t(user_id, "batch_queued").format(total=len(items)))
+    destination = user_destination(user_id)
+    batch_id, jobs = await create_batch(user_id, message.chat.id, message.id, status_msg.id, items, rejected, destination)
+    for job in jobs:
+        scheduler.submit(job)
+    start_batch(batch_id)
+    log_event(f"Lote {batch_id} de {user_id}: {len(jobs)} trabajos, {len(rejected)} enlaces descartados.",
+              user_id=user_id, batch_id=batch_id)
+
+async def ingest_urls(message, urls):
+    user_id = message.from_user.id
+    if len(urls) > BATCH_MAX_URLS:
+        await message.reply(t(user_id, "batch_too_many").format(max=BATCH_MAX_URLS))
+        return
+    if len(urls) == 1:
+        # Un solo enlace sigue el flujo de siempre, pero sin gastar un hueco del pool si no es un video
+        verdict = (await validate_urls(urls))[0]
+        if not verdict["ok"]:
+            await message.reply(t(user_id, "link_rejected").format(reason=probe_reason(user_id, verdict)))
+            log_event(f"Enlace descartado de {user_id}: {urls[0]} ({verdict['reason']})", user_id=user_id)
+            return
+        log_event(f"Video recibido de {user_id} (URL): {urls[0]}", user_id=user_id)
+        await enqueue_video(message, urls[0])
+        return
+    status_msg = await message.reply(t(user_id, "batch_validating").format(count=len(urls)))
+    verdicts = await validate_urls(urls)
+    valid = [url for url, verdict in zip(urls, verdicts) if verdict["ok"]]
+    rejected = [(url, probe_reason(user_id, verdict)) for url, verdict in zip(urls, verdicts) if not verdict["ok"]]
+    await enqueue_batch(message, valid, rejected, status_msg)
+
+async def ingest_link_file(message):
+    user_id = message.from_user.id
+    if (message.document.file_size or 0) > LINK_FILE_MAX_BYTES:
+        await message.reply(t(user_id, "link_file_too_big").format(max=format_bytes(LINK_FILE_MAX_BYTES)))
+        return
+    data = await message.download(in_memory=True)
+    urls = extract_urls(data.getvalue().decode("utf-8", errors="replace") + "\n" + (message.caption or ""))
+    if not urls:
+        await message.reply(t(user_id, "main_instruction"))
+        return
+    log_event(f"Archivo de enlaces de {user_id}: {len(urls)} URLs", user_id=user_id)
+    await ingest_urls(message, urls)
+
+async def flush_media_group(group_id):
+    await asyncio.sleep(MEDIA_GROUP_WAIT)
+    message, items = media_groups.pop(group_id)
+    try:
+        if len(items) == 1:
+            await enqueue_video(message, items[0])
+        else:
+            await enqueue_batch(message, items)
+    except Exception as e:
+        log_event(f"Error encolando el álbum {group_id}: {e}", level="error", user_id=message.from_user.id)
+
+def collect_media_group(message, video_info):
+    """Agrupa las partes de un álbum de Telegram (llegan como mensajes sueltos) en un solo lote."""
+    group = media_groups.get(message.media_group_id)
+    if group:
+        group[1].append(video_info)
+        return
+    media_groups[message.media_group_id] = (message, [video_info])
+    asyncio.create_task(flush_media_group(message.media_group_id))
+
+def batch_counts(rows):
+    counts = {"queued": 0, "running": 0, "done": 0, "failed": 0, "cancelled": 0}
+    for row in rows:
+        counts[row["state"]] += 1
+    return counts
+
+def batch_results(rows):
+    lines = []
+    for row in rows:
+        video_info = json.loads(row["video_info"])
+        name = video_info.get("file_name") if isinstance(video_info, dict) else video_info
+        shown = row["result"] if row["state"] == "done" and row["stage"] != "video_done_telegram" else row["state"]
+        lines.append(f"{name}: {shown}")
+    return "\n".join(lines)
+
+async def run_batch(batch_id):
+    batch = (await db_run("SELECT * FROM batches WHERE id = ?", (batch_id,)))[0]
+    user_id, chat_id = batch["user_id"], batch["chat_id"]
+    rejected = json.loads(batch["rejected"])
+
+    def progress_text(counts):
+        finished = counts["done"] + counts["failed"] + counts["cancelled"]
+        return "\n".join([
+            t(user_id, "batch_progress").format(total=batch["total"], done=counts["done"], running=counts["running"],
+                                                queued=counts["queued"], failed=counts["failed"], rejected=len(rejected)),
+            make_progress_bar(finished / batch["total"] * 100 if batch["total"] else 100),
+        ])
+
+    last_text = None
+    while True:
+        rows = await db_run("SELECT state, stage, result, video_info FROM jobs WHERE batch_id = ? ORDER BY id", (batch_id,))
+        counts = batch_counts(rows)
+        if not counts["queued"] and not counts["running"]:
+            break
+        text = progress_text(counts)
+        if text != last_text:
+            try:
+                await app.edit_message_text(chat_id, batch["status_msg_id"], text)
+                last_text = text
+            except FloodWait as e:
+                FLOOD_WAITS.inc(source="progress")
+                await asyncio.sleep(e.value)
+            except Exception as e:
+                log_event(f"Error actualizando progreso del lote {batch_id}: {e}", level="error", batch_id=batch_id)
+        await asyncio.sleep(PROGRESS_INTERVAL)
+
+    await db_run("UPDATE batches SET state = 'done' WHERE id = ?", (batch_id,))
+    summary = t(user_id, "batch_done").format(done=counts["done"], total=batch["total"], failed=counts["failed"],
+                                               cancelled=counts["cancelled"], rejected=len(rejected))
+    try:
+        await app.edit_message_text(chat_id, batch["status_msg_id"], progress_text(counts))
+    except Exception:
+        pass
+    results = batch_results(rows)
+    if rejected:
+        results += f"\n\n{t(user_id, 'batch_rejected')}\n" + "\n".join(f"{url}: {reason}" for url, reason in rejected)
+    if len(results) <= BATCH_RESULTS_INLINE:
+        await send_message_retry(chat_id, f"{summary}\n\n{results}", reply_to_message_id=batch["status_msg_id"],
+                                 parse_mode=enums.ParseMode.DISABLED, disable_web_page_preview=True)
+    else:
+        document = io.BytesIO((results + "\n").encode("utf-8"))
+        document.name = f"lote_{batch_id}.txt"
+        await app.send_document(chat_id, document, caption=summary, reply_to_message_id=batch["status_msg_id"])
+    log_event(f"Lote {batch_id} terminado: {counts['done']}/{batch['total']} subidos, {counts['failed']} fallidos.",
+              user_id=user_id, batch_id=batch_id)
+
+def start_batch(batch_id):
+    task = asyncio.create_task(run_batch(batch_id))
+    batch_tasks[batch_id] = task
+    task.add_done_callback(lambda _: batch_tasks.pop(batch_id, None))
+
+async def resume_batches():
+    rows = await db_run("SELECT id FROM batches WHERE state = 'running'")
+    for row in rows:
+        start_batch(row["id"])
+
+async def stop_batches():
+    tasks = list(batch_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
 # --- COMANDOS Y MANEJO DE MENSAJES ---
 
@@ -169,11 +2774,10 @@ async def start(client, message):
     user_id = message.from_user.id
     lang = get_user_lang(user_id)
     allowed_users.add(user_id)
-    save_json("allowed_users.json", list(allowed_users))
     await message.reply(LANGS[lang]["welcome"])
     user_server[str(user_id)] = "hydrax"
     user_hydrax_api[str(user_id)] = HYDRAX_API_ID
-    log_event(f"Usuario {user_id} inició el bot.")
+    log_event(f"Usuario {user_id} inició el bot.", user_id=user_id)
 
 @app.on_message(filters.command("setlang"))
 async def setlang(client, message):
@@ -183,16 +2787,15 @@ async def setlang(client, message):
          InlineKeyboardButton("🇺🇸 English", callback_data="lang_en")]
     ])
     await message.reply(t(user_id, "choose_lang"), reply_markup=kb)
-    log_event(f"Usuario {user_id} solicitó cambio de idioma.")
+    log_event(f"Usuario {user_id} solicitó cambio de idioma.", user_id=user_id)
 
 @app.on_callback_query(filters.regex("^lang_"))
 async def lang_callback(client, callback_query):
     user_id = callback_query.from_user.id
     lang_code = callback_query.data.split("_")[1]
     user_langs[str(user_id)] = lang_code
-    save_json("user_langs.json", user_langs)
     await callback_query.message.edit_text(LANGS[lang_code]["lang_set"])
-    log_event(f"Usuario {user_id} cambió idioma a {lang_code}.")
+    log_event(f"Usuario {user_id} cambió idioma a {lang_code}.", user_id=user_id)
 
 @app.on_message(filters.command("ayuda"))
 async def ayuda(client, message):
@@ -204,15 +2807,119 @@ async def ayuda(client, message):
         "• <b>/ayuda</b> — Muestra esta ayuda detallada 🆘.\n"
         "• <b>/cancel</b> — Cancela la operación en curso ⏹️.\n"
         "• <b>/hapi</b> — Cambia la API Key de Hydrax 🔑.\n"
-        "• <b>/log</b> — Recupera el registro de actividad 📄.\n"
+        "• <b>/log</b> — Recupera el registro de actividad 📄 (filtros: user=, job=, level=, since=, grep=, limit=).\n"
         "• <b>/ping</b> — Mide la latencia del bot 📶.\n"
         "• <b>/remove</b> — Elimina un usuario de la lista de permitidos 🚫.\n"
         "• <b>/server</b> — Selecciona el destino de subida 🌐.\n"
-        "• <b>/setlang</b> — Cambia el idioma del bot 🇪🇸🇺🇸.\n\n"
+        "• <b>/setlang</b> — Cambia el idioma del bot 🇪🇸🇺🇸.\n"
+        "• <b>/stats</b> — Métricas de rendimiento (solo creador) 📊.\n\n"
         "👉 <i>Envía un video, documento de tipo video o enlace directo para subirlo a Hydrax.</i>"
     )
-    await message.reply(ayuda_text, parse_mode="HTML")
-    log_event(f"Usuario {user_id} solicitó ayuda.")
+    await message.reply(ayuda_text, parse_mode=enums.ParseMode.HTML)
+    log_event(f"Usuario {user_id} solicitó ayuda.", user_id=user_id)
+
+# --- Consulta del log: /log [user=ID] [job=ID] [level=warning] [since=2h] [grep=texto] [limit=N] ---
+LOG_QUERY_LIMIT = int(os.getenv("LOG_QUERY_LIMIT", "500"))   # líneas devueltas por defecto (las más recientes)
+LOG_INLINE_CHARS = 3500                                      # por debajo se responde con texto, si no con documento
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def parse_duration(value):
+    unit = value[-1].lower()
+    if unit in DURATION_UNITS:
+        return float(value[:-1]) * DURATION_UNITS[unit]
+    return float(value)
+
+def parse_log_filters(args):
+    """Convierte los argumentos clave=valor de /log en filtros. Lanza ValueError si alguno no es válido."""
+    filters_ = {"limit": LOG_QUERY_LIMIT}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        key = key.lower()
+        if not sep or not value:
+            raise ValueError(arg)
+        if key == "user":
+            filters_["user_id"] = int(value)
+        elif key == "job":
+            filters_["job_id"] = int(value)
+        elif key == "level":
+            level = logging.getLevelName(value.upper())
+            if not isinstance(level, int):
+                raise ValueError(arg)
+            filters_["level"] = level
+        elif key == "since":
+            filters_["since"] = datetime.now(timezone.utc).timestamp() - parse_duration(value)
+        elif key == "grep":
+            filters_["grep"] = value.lower()
+        elif key == "limit":
+            filters_["limit"] = max(1, int(value))
+        else:
+            raise ValueError(arg)
+    return filters_
+
+def log_files(since=None):
+    """Ficheros de log de más antiguo a más reciente, saltando los rotados que terminan antes de `since`.
+
+    Incluye los logs de los workers (bot-worker-*.log) que estén en la misma carpeta.
+    """
+    log_dir = os.path.dirname(LOG_FILE) or "."
+    bases = [LOG_FILE] + sorted(
+        os.path.join(log_dir, name) for name in os.listdir(log_dir)
+        if name.startswith("bot-worker-") and name.endswith(".log") and os.path.join(log_dir, name) != LOG_FILE
+    )
+    files = []
+    for base in bases:
+        for n in range(LOG_BACKUPS, 0, -1):
+            path = f"{base}.{n}.gz"
+            if os.path.exists(path) and (since is None or os.path.getmtime(path) >= since):
+                files.append(path)
+        if os.path.exists(base):
+            files.append(base)
+    return files
+
+def log_line_matches(line, filters_):
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        entry = None
+    if not isinstance(entry, dict):
+        # Líneas en texto plano (formato antiguo): solo se pueden filtrar con grep
+        if any(k in filters_ for k in ("user_id", "job_id", "level", "since")):
+            return False
+        return "grep" not in filters_ or filters_["grep"] in line.lower()
+    if "user_id" in filters_ and entry.get("user_id") != filters_["user_id"]:
+        return False
+    if "job_id" in filters_ and entry.get("job_id") != filters_["job_id"]:
+        return False
+    if "level" in filters_ and logging.getLevelName(str(entry.get("level", "")).upper()) < filters_["level"]:
+        return False
+    if "since" in filters_:
+        try:
+            if datetime.fromisoformat(entry["ts"]).timestamp() < filters_["since"]:
+                return False
+        except (KeyError, ValueError):
+            return False
+    return "grep" not in filters_ or filters_["grep"] in str(entry.get("msg", "")).lower()
+
+def search_logs(filters_):
+    """Recorre los logs línea a línea (sin cargarlos enteros) y devuelve las `limit` coincidencias más recientes."""
+    limit = filters_["limit"]
+    matches = {}    # fichero base: deque con sus últimas coincidencias
+    total = 0
+    for path in log_files(filters_.get("since")):
+        found = matches.setdefault(re.sub(r"\.\d+\.gz$", "", path), deque(maxlen=limit))
+        opener = gzip.open if path.endswith(".gz") else open
+        try:
+            with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if line and log_line_matches(line, filters_):
+                        found.append(line)
+                        total += 1
+        except (OSError, EOFError) as e:
+            found.append(f"[no se pudo leer {path}: {e}]")
+    # Con workers hay un fichero por proceso: se mezclan por el prefijo {"ts": "<fecha ISO>" (orden estable en empates)
+    lines = sorted((line for found in matches.values() for line in found), key=lambda line: line[:38])
+    return lines[-limit:], total
 
 @app.on_message(filters.command("log"))
 async def send_log(client, message):
@@ -220,11 +2927,37 @@ async def send_log(client, message):
     if user_id != CREATOR_ID:
         await message.reply(t(user_id, "not_allowed"))
         return
-    if os.path.exists("bot.log"):
-        await message.reply_document("bot.log", caption="Registro de actividad del bot")
-        log_event(f"Usuario {user_id} solicitó el log.")
-    else:
-        await message.reply("No existe el archivo de log.")
+    args = message.text.split()[1:]
+    if not args:
+        # Sin filtros se envía el log actual completo, como siempre
+        if os.path.exists(LOG_FILE):
+            await message.reply_document(LOG_FILE, caption="Registro de actividad del bot")
+            log_event(f"Usuario {user_id} solicitó el log.", user_id=user_id)
+        else:
+            await message.reply("No existe el archivo de log.")
+        return
+    try:
+        filters_ = parse_log_filters(args)
+    except ValueError as e:
+        await message.reply(
+            f"Filtro no válido: {e}\n"
+            "Uso: /log [user=ID] [job=ID] [level=info|warning|error] [since=30m|2h|1d] [grep=texto] [limit=N]"
+        )
+        return
+    # La lectura (y descompresión de los rotados) va en un hilo para no bloquear el bucle de eventos
+    lines, total = await asyncio.to_thread(search_logs, filters_)
+    log_event(f"Usuario {user_id} consultó el log con filtros: {' '.join(args)}", user_id=user_id)
+    if not lines:
+        await message.reply("Ninguna línea del log coincide con los filtros.")
+        return
+    header = f"{len(lines)} de {total} líneas coincidentes (las más recientes)"
+    text = "\n".join(lines)
+    if len(text) <= LOG_INLINE_CHARS:
+        await message.reply(f"{header}\n\n{text}", parse_mode=enums.ParseMode.DISABLED)
+        return
+    document = io.BytesIO((text + "\n").encode("utf-8"))
+    document.name = "log_filtrado.jsonl"
+    await message.reply_document(document, caption=header)
 
 @app.on_message(filters.command("add"))
 async def add_user(client, message):
@@ -235,12 +2968,11 @@ async def add_user(client, message):
     try:
         new_id = int(message.text.strip().split(" ")[1])
         allowed_users.add(new_id)
-        save_json("allowed_users.json", list(allowed_users))
         await message.reply(f"Usuario {new_id} añadido a la whitelist.")
-        log_event(f"Usuario {new_id} añadido por {user_id}.")
+        log_event(f"Usuario {new_id} añadido por {user_id}.", user_id=user_id)
     except Exception as e:
         await message.reply("Error en el formato. Usa /add <user_id>")
-        log_event(f"Error añadiendo usuario: {e}")
+        log_event(f"Error añadiendo usuario: {e}", level="error")
 
 @app.on_message(filters.command("remove"))
 async def remove_user(client, message):
@@ -251,12 +2983,11 @@ async def remove_user(client, message):
     try:
         rem_id = int(message.text.strip().split(" ")[1])
         allowed_users.discard(rem_id)
-        save_json("allowed_users.json", list(allowed_users))
         await message.reply(f"Usuario {rem_id} eliminado de la whitelist.")
-        log_event(f"Usuario {rem_id} eliminado por {user_id}.")
+        log_event(f"Usuario {rem_id} eliminado por {user_id}.", user_id=user_id)
     except Exception as e:
         await message.reply("Error en el formato. Usa /remove <user_id>")
-        log_event(f"Error eliminando usuario: {e}")
+        log_event(f"Error eliminando usuario: {e}", level="error")
 
 @app.on_message(filters.command("ping"))
 async def ping_command(client, message):
@@ -266,7 +2997,56 @@ async def ping_command(client, message):
     end = time.time()
     ms = int((end - start) * 1000)
     await sent.edit_text(t(user_id, "pong").format(ms=ms))
-    log_event(f"Usuario {user_id} usó /ping: {ms}ms")
+    log_event(f"Usuario {user_id} usó /ping: {ms}ms", user_id=user_id)
+
+@app.on_message(filters.command("stats"))
+async def stats_command(client, message):
+    user_id = message.from_user.id
+    if user_id != CREATOR_ID:
+        await message.reply(t(user_id, "not_allowed"))
+        return
+
+    def seconds(value):
+        return "-" if value is None else f"{value:.1f}s"
+
+    # En modo frontend los bytes, el disco, las claves y las latencias salen de los workers (ver worker_stats)
+    workers = await worker_stats()
+    transferred = cluster_metric(BYTES_TRANSFERRED, workers)
+    stage_seconds = cluster_metric(JOB_STAGE_SECONDS, workers)
+    rates = cluster_throughput(workers)
+    lag_p99 = LOOP_LAG_SECONDS.quantile(0.99)
+    disk = await asyncio.to_thread(temp_storage.usage)
+    disk.update(cluster_temp(workers))
+
+    lines = [
+        "📊 <b>Estadísticas</b>",
+        f"• Trabajos en curso: {scheduler.running_count()} / {scheduler.workers}",
+        f"• En cola: {scheduler.pending_count()} ({len(scheduler.queues)} usuarios)",
+        *([f"• Workers: {scheduler.alive} procesos vivos · {len(scheduler.children)} lanzados por el frontend"]
+          if BOT_MODE == "frontend" else []),
+        f"• Descarga: {format_bytes(rates['download'])}/s · Subida: {format_bytes(rates['upload'])}/s",
+        f"• Total descargado: {format_bytes(transferred.get(direction='download'))} · subido: {format_bytes(transferred.get(direction='upload'))}",
+        f"• Terminados: {JOBS_FINISHED.get(result='done')} · caché: {JOBS_FINISHED.get(result='cached')} · fallidos: {JOBS_FINISHED.get(result='failed')}",
+        f"• Errores Hydrax: {sum(cluster_metric(HYDRAX_ERRORS, workers).values.values())} · "
+        f"FloodWait: {sum(cluster_metric(FLOOD_WAITS, workers).values.values())}",
+        f"• Retraso del event loop: último {loop_lag_last * 1000:.0f} ms · p99 {'-' if lag_p99 is None else f'{lag_p99 * 1000:.0f}'} ms",
+        f"• Disco temporal: {format_bytes(disk['reserved'])} reservados de {format_bytes(disk['budget'])} · "
+        f"{format_bytes(disk['on_disk'])} en uso · {format_bytes(disk['free'])} libres · {disk['waiting']} trabajos esperando espacio",
+        "",
+        "<b>Latencia por etapa (p50 / p95)</b>",
+    ]
+    for stage in ("queued", "downloading", "streaming", "uploading", "total"):
+        if stage_seconds.count(stage=stage):
+            lines.append(f"• {stage}: {seconds(stage_seconds.quantile(0.5, stage=stage))} / {seconds(stage_seconds.quantile(0.95, stage=stage))}")
+    keys = cluster_key_stats(workers)
+    if keys:
+        lines += ["", "<b>Claves de Hydrax</b>"]
+        circuit = {"closed": "✅", "half_open": "🟡", "open": "⛔"}
+        for key in keys:
+            lines.append(f"• {circuit[key['state']]} {html.escape(key['key'])}: {key['uploads']} subidas · {key['errors']} errores · "
+                         f"{key['active']} en curso · {format_bytes(key['bytes'])} · {format_bytes(key['speed'])}/s")
+    await message.reply("\n".join(lines), parse_mode=enums.ParseMode.HTML)
+    log_event(f"Usuario {user_id} usó /stats.", user_id=user_id)
 
 @app.on_message(filters.command("server"))
 async def server_command(client, message):
@@ -276,16 +3056,15 @@ async def server_command(client, message):
          InlineKeyboardButton("🦎Hydrax", callback_data="server_hydrax")]
     ])
     await message.reply(t(user_id, "choose_server"), reply_markup=kb)
-    log_event(f"Usuario {user_id} solicitó /server.")
+    log_event(f"Usuario {user_id} solicitó /server.", user_id=user_id)
 
 @app.on_callback_query(filters.regex("^server_"))
 async def server_callback(client, callback_query):
     user_id = callback_query.from_user.id
     srv = callback_query.data.split("_")[1]
     user_server[str(user_id)] = srv
-    save_json("user_server.json", user_server)
     await callback_query.message.edit_text(t(user_id, f"server_set_{srv}"))
-    log_event(f"Usuario {user_id} cambió server a {srv}.")
+    log_event(f"Usuario {user_id} cambió server a {srv}.", user_id=user_id)
 
 @app.on_message(filters.command("hapi"))
 async def hapi_command(client, message):
@@ -293,11 +3072,11 @@ async def hapi_command(client, message):
     await message.reply(t(user_id, "send_hapi"))
     user_pending_hapi[user_id] = None
 
-@app.on_message(filters.text & filters.user(list(allowed_users)))
+@app.on_message((filters.text | filters.video | filters.document) & filters.user(list(allowed_users)))
 async def hapi_receive(client, message):
     user_id = message.from_user.id
     # Si está esperando API de Hydrax:
-    if user_id in user_pending_hapi and user_pending_hapi[user_id] is None:
+    if message.text and user_id in user_pending_hapi and user_pending_hapi[user_id] is None:
         api_candidate = message.text.strip()
         user_pending_hapi[user_id] = api_candidate
         kb = InlineKeyboardMarkup([
@@ -305,11 +3084,11 @@ async def hapi_receive(client, message):
              InlineKeyboardButton("🚫No", callback_data="hapi_cancel")]
         ])
         await message.reply(t(user_id, "confirm_hapi").format(api=api_candidate), reply_markup=kb)
-        log_event(f"Usuario {user_id} envió api para /hapi (pendiente confirmación)")
+        log_event(f"Usuario {user_id} envió api para /hapi (pendiente confirmación)", user_id=user_id)
         return
 
     # Si está en proceso de anuncio (solo CREATOR_ID)
-    if user_id == CREATOR_ID and user_id in user_ads_state:
+    if message.text and user_id == CREATOR_ID and user_id in user_ads_state:
         state = user_ads_state[user_id]
         if state["step"] == "collecting":
             state["messages"].append(message.text)
@@ -319,37 +3098,40 @@ async def hapi_receive(client, message):
             ])
             await message.reply(t(user_id, "ads_add_more"), reply_markup=kb)
             state["step"] = "add_more"
-            log_event(f"Anuncio: Añadido mensaje por {user_id}")
+            log_event(f"Anuncio: Añadido mensaje por {user_id}", user_id=user_id)
             return
 
     # --- VIDEO/URL ENTRANTE ---
-    if user_server.get(str(user_id), "hydrax") == "hydrax":
+    if user_destination(user_id) in UPLOAD_DESTINATIONS:
         # Video de Telegram
         if message.video or (message.document and (message.document.mime_type or "").startswith("video/")):
             # Soporta videos y documentos de tipo video
             file_id = message.video.file_id if message.video else message.document.file_id
             file_name = (message.video.file_name if message.video else message.document.file_name) or "video.mp4"
             file_type = (message.video.mime_type if message.video else message.document.mime_type) or "video/mp4"
+            file_size = (message.video.file_size if message.video else message.document.file_size) or 0
+            file_unique_id = message.video.file_unique_id if message.video else message.document.file_unique_id
             video_info = {
                 "file_id": file_id,
+                "file_unique_id": file_unique_id,
                 "file_name": file_name,
-                "mime_type": file_type
+                "mime_type": file_type,
+                "file_size": file_size
             }
-            user_video_queue.setdefault(user_id, []).append((message, video_info))
-            log_event(f"Video recibido de {user_id} (Telegram): {file_name}")
-            if not user_uploading.get(user_id, False):
-                asyncio.create_task(process_video_queue(user_id))
+            log_event(f"Video recibido de {user_id} (Telegram): {file_name}", user_id=user_id)
+            if message.media_group_id:
+                collect_media_group(message, video_info)
             else:
-                await message.reply(t(user_id, "video_queued"))
+                await enqueue_video(message, video_info)
             return
-        # URL directa
-        if is_direct_video_url(message.text):
-            user_video_queue.setdefault(user_id, []).append((message, message.text.strip()))
-            log_event(f"Video recibido de {user_id} (URL): {message.text.strip()}")
-            if not user_uploading.get(user_id, False):
-                asyncio.create_task(process_video_queue(user_id))
-            else:
-                await message.reply(t(user_id, "video_queued"))
+        # Archivo .txt/.csv con un enlace por línea
+        if message.document and is_link_file(message.document):
+            await ingest_link_file(message)
+            return
+        # Uno o varios enlaces directos (uno por línea)
+        urls = extract_urls(message.text)
+        if urls:
+            await ingest_urls(message, urls)
             return
 
     # RESPUESTA PARA MENSAJES NO COMANDO NI VIDEO
@@ -363,13 +3145,12 @@ async def hapi_confirm_callback(client, callback_query):
         return
     if callback_query.data == "hapi_ok":
         user_hydrax_api[str(user_id)] = user_pending_hapi[user_id]
-        save_json("user_hydrax_api.json", user_hydrax_api)
         await callback_query.message.edit_text(t(user_id, "hapi_set_ok"))
-        log_event(f"Usuario {user_id} confirmó nueva api Hydrax.")
+        log_event(f"Usuario {user_id} confirmó nueva api Hydrax.", user_id=user_id)
         del user_pending_hapi[user_id]
     else:
         await callback_query.message.edit_text(t(user_id, "hapi_set_cancel"))
-        log_event(f"Usuario {user_id} canceló cambio api Hydrax.")
+        log_event(f"Usuario {user_id} canceló cambio api Hydrax.", user_id=user_id)
         del user_pending_hapi[user_id]
 
 @app.on_message(filters.command("cancel"))
@@ -379,16 +3160,171 @@ async def cancel_command(client, message):
     if user_id in user_ads_state:
         del user_ads_state[user_id]
         await message.reply(t(user_id, "cancel_ok"))
-        log_event(f"Usuario {user_id} canceló anuncio en curso.")
+        log_event(f"Usuario {user_id} canceló anuncio en curso.", user_id=user_id)
         return
     # Vacía la cola de videos
-    if user_video_queue.get(user_id):
-        user_video_queue[user_id] = []
+    cancelled = scheduler.cancel_user(user_id)
+    if cancelled:
+        await cancel_jobs([job["id"] for job in cancelled])
         await message.reply(t(user_id, "video_cancelled"))
-        log_event(f"Usuario {user_id} vació la cola de videos.")
+        log_event(f"Usuario {user_id} vació la cola de videos.", user_id=user_id)
         return
     await message.reply(t(user_id, "cancel_ok"))
-    log_event(f"Usuario {user_id} usó /cancel.")
+    log_event(f"Usuario {user_id} usó /cancel.", user_id=user_id)
+
+# --- MOTOR DE DIFUSIÓN (/ads) ---
+
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))              # mensajes/s en total (límite de bots ≈ 30/s)
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))   # destinatarios atendidos a la vez
+BROADCAST_RETRIES = 3
+BLOCKED_ERRORS = (UserIsBlocked, InputUserDeactivated, PeerIdInvalid, UserDeactivated, UserDeactivatedBan, ChatWriteForbidden, UserIsBot)
+
+class TokenBucket:
+    """Limitador global: como mucho `rate` operaciones por segundo con ráfagas de hasta `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+broadcast_tasks = {}    # campaign_id: asyncio.Task
+
+async def create_campaign(owner_id, messages, recipients):
+    def insert():
+        with db_lock:
+            db.execute("BEGIN")
+            campaign_id = db.execute(
+                "INSERT INTO campaigns (messages, owner_id, created_at) VALUES (?, ?, ?)",
+                (json.dumps(messages), owner_id, time.time()),
+            ).lastrowid
+            db.executemany(
+                "INSERT INTO campaign_recipients (campaign_id, user_id) VALUES (?, ?)",
+                [(campaign_id, u) for u in recipients],
+            )
+            db.execute("COMMIT")
+            return campaign_id
+    return await asyncio.to_thread(insert)
+
+async def send_ad(campaign_id, user_id, messages, parts_sent):
+    """Envía las partes pendientes del anuncio a un usuario. Devuelve 'sent', 'blocked' o 'failed'."""
+    for index in range(parts_sent, len(messages)):
+        attempt = 0
+        while True:
+            await broadcast_bucket.acquire()
+            try:
+                await app.send_message(user_id, messages[index])
+                break
+            except FloodWait as e:
+                # Solo este destinatario espera lo que pide Telegram; el resto sigue enviando.
+                # No cuenta como intento: el envío no falló, solo se aplazó.
+                FLOOD_WAITS.inc(source="broadcast")
+                log_event(f"FloodWait de {e.value}s enviando anuncio a {user_id}", level="warning", user_id=user_id)
+                await asyncio.sleep(e.value)
+            except BLOCKED_ERRORS as e:
+                log_event(f"Usuario {user_id} no disponible para anuncios: {e}", user_id=user_id)
+                return "blocked"
+            except Exception as e:
+                attempt += 1
+                log_event(f"Fallo al enviar anuncio a {user_id} (intento {attempt}): {e}", level="error", user_id=user_id)
+                if attempt == BROADCAST_RETRIES:
+                    return "failed"
+                await asyncio.sleep(2 ** (attempt - 1))
+        await db_run("UPDATE campaign_recipients SET parts_sent = ? WHERE campaign_id = ? AND user_id = ?",
+                     (index + 1, campaign_id, user_id))
+    return "sent"
+
+def campaign_counts(rows):
+    counts = {"pending": 0, "sent": 0, "blocked": 0, "failed": 0}
+    for row in rows:
+        counts[row["status"]] += 1
+    return counts
+
+async def run_campaign(campaign_id):
+    campaign = (await db_run("SELECT * FROM campaigns WHERE id = ?", (campaign_id,)))[0]
+    owner_id = campaign["owner_id"]
+    messages = json.loads(campaign["messages"])
+    rows = await db_run("SELECT user_id, status, parts_sent FROM campaign_recipients WHERE campaign_id = ?", (campaign_id,))
+    counts = campaign_counts(rows)
+    total = len(rows)
+    pending = deque(row for row in rows if row["status"] == "pending")
+
+    def progress_text():
+        return t(owner_id, "ads_progress").format(sent=counts["sent"], total=total, blocked=counts["blocked"], failed=counts["failed"])
+
+    if campaign["progress_msg_id"]:
+        progress_msg_id = campaign["progress_msg_id"]
+    else:
+        progress_msg_id = (await app.send_message(owner_id, progress_text())).id
+        await db_run("UPDATE campaigns SET progress_msg_id = ? WHERE id = ?", (progress_msg_id, campaign_id))
+
+    async def sender():
+        while pending:
+            row = pending.popleft()
+            status = await send_ad(campaign_id, row["user_id"], messages, row["parts_sent"])
+            counts[status] += 1
+            counts["pending"] -= 1
+            await db_run("UPDATE campaign_recipients SET status = ? WHERE campaign_id = ? AND user_id = ?",
+                         (status, campaign_id, row["user_id"]))
+
+    async def reporter():
+        last_text = None
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            text = progress_text()
+            if text == last_text:
+                continue
+            try:
+                await app.edit_message_text(owner_id, progress_msg_id, text)
+                last_text = text
+            except FloodWait as e:
+                FLOOD_WAITS.inc(source="progress")
+                await asyncio.sleep(e.value)
+            except Exception as e:
+                log_event(f"Error actualizando progreso del anuncio {campaign_id}: {e}", level="error", campaign_id=campaign_id)
+
+    progress = asyncio.create_task(reporter())
+    try:
+        await asyncio.gather(*(sender() for _ in range(min(BROADCAST_CONCURRENCY, len(pending)))))
+    finally:
+        progress.cancel()
+    await db_run("UPDATE campaigns SET state = 'done' WHERE id = ?", (campaign_id,))
+    try:
+        await app.edit_message_text(owner_id, progress_msg_id, progress_text())
+    except Exception:
+        pass
+    await app.send_message(owner_id, t(owner_id, "ads_summary").format(sent=counts["sent"], total=total, blocked=counts["blocked"], failed=counts["failed"]))
+    log_event(f"Anuncio {campaign_id} enviado: {counts['sent']} usuarios, {counts['blocked']} bloqueados, {counts['failed']} con error.", campaign_id=campaign_id)
+
+def start_campaign(campaign_id):
+    task = asyncio.create_task(run_campaign(campaign_id))
+    broadcast_tasks[campaign_id] = task
+    task.add_done_callback(lambda _: broadcast_tasks.pop(campaign_id, None))
+
+async def resume_campaigns():
+    rows = await db_run("SELECT id FROM campaigns WHERE state = 'running'")
+    for row in rows:
+        log_event(f"Reanudando anuncio {row['id']} interrumpido.")
+        start_campaign(row["id"])
+
+async def stop_campaigns():
+    tasks = list(broadcast_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
 # ----------------------- ANUNCIOS /ads ------------------------------
 
@@ -397,7 +3333,7 @@ async def ads_command(client, message):
     user_id = message.from_user.id
     if user_id != CREATOR_ID:
         await message.reply(t(user_id, "not_allowed"))
-        log_event(f"Usuario {user_id} intentó usar /ads sin permiso.")
+        log_event(f"Usuario {user_id} intentó usar /ads sin permiso.", level="warning", user_id=user_id)
         return
     user_ads_state[user_id] = {"step": "collecting", "messages": []}
     await message.reply(t(user_id, "ads_first"))
@@ -431,30 +3367,67 @@ async def ads_callback(client, callback_query):
         log_event("Anuncio cancelado (/ads)")
         return
     if callback_query.data == "ads_send":
-        state["step"] = "sending"
-        preview = "\n\n".join(state["messages"])
+        # Se retira el estado antes del primer await: un segundo toque ya no pasa la comprobación de arriba
+        del user_ads_state[user_id]
         await callback_query.message.edit_text(t(user_id, "ads_sending"))
         users_to_send = [u for u in allowed_users if u != CREATOR_ID]
-        sent = 0
-        blocked = 0
-        total = len(users_to_send)
-        progress_msg = await app.send_message(CREATOR_ID, t(user_id, "ads_progress").format(sent=sent, total=total, blocked=blocked))
-        for u in users_to_send:
-            try:
-                for msg in state["messages"]:
-                    await app.send_message(u, msg)
-                    time.sleep(0.5)
-                sent += 1
-            except Exception as e:
-                log_event(f"Fallo al enviar anuncio a {u}: {e}")
-                blocked += 1
-            await progress_msg.edit_text(t(user_id, "ads_progress").format(sent=sent, total=total, blocked=blocked))
-        await app.send_message(CREATOR_ID, t(user_id, "ads_summary").format(sent=sent, total=total, blocked=blocked))
-        log_event(f"Anuncio enviado: {sent} usuarios, {blocked} bloqueados.")
-        del user_ads_state[user_id]
+        campaign_id = await create_campaign(user_id, state["messages"], users_to_send)
+        # La difusión corre en segundo plano: el bot sigue atendiendo mientras tanto
+        start_campaign(campaign_id)
+        log_event(f"Anuncio {campaign_id} en marcha para {len(users_to_send)} usuarios.", campaign_id=campaign_id)
         return
 
+async def run_worker():
+    await app.start()
+    # Con otros workers vivos no se limpia temp/: sus archivos en curso aún no constan como huérfanos
+    others = await db_run(
+        "SELECT COUNT(*) AS n FROM workers WHERE id != ? AND heartbeat > ?", (WORKER_ID, time.time() - WORKER_TIMEOUT)
+    )
+    await temp_storage.start(sweep=not others[0]["n"])
+    # Mide la velocidad actual que el worker publica con su latido
+    monitor = asyncio.create_task(monitor_event_loop())
+    worker = JobWorker(WORKER_ID, MAX_WORKERS, MAX_JOBS_PER_USER)
+    await worker.start()
+    await idle()
+    await worker.stop()
+    monitor.cancel()
+    await close_media_session()
+    await app.stop()
+    await close_hydrax_session()
+    await close_http_session()
+
+async def main():
+    if BOT_MODE == "worker":
+        await run_worker()
+        return
+    await app.start()
+    if BOT_MODE == "all":
+        await temp_storage.start()
+        await recover_jobs()
+    else:
+        # Frontend: los trabajos pendientes siguen en bot.db y los recogen los workers
+        await prune_jobs()
+    scheduler.start()
+    flusher = asyncio.create_task(settings_flusher())
+    await resume_campaigns()
+    await resume_batches()
+    monitor = asyncio.create_task(monitor_event_loop())
+    metrics_runner = await start_metrics_server()
+    log_event(f"Bot iniciado (modo {BOT_MODE}).")
+    await idle()
+    monitor.cancel()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await stop_campaigns()
+    await stop_batches()
+    await scheduler.stop()
+    flusher.cancel()
+    await flush_settings()
+    await close_media_session()
+    await app.stop()
+    await close_hydrax_session()
+    await close_http_session()
+
 if __name__ == "__main__":
-    log_event("Bot iniciado.")
     print("Si aparece el mensaje de TgCrypto, instala con: pip install tgcrypto para mejorar la velocidad de descarga de videos de Telegram.")
-    app.run()
+    app.run(main())